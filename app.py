@@ -1,20 +1,26 @@
 import asyncio
-from fastapi import FastAPI
+import hmac
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
-from vk_bot import bot, start_bot
+from vk_bot import TRACES_TOKEN, VK_MODE, bot, export_traces, handle_callback, metrics, start_bot, start_services, stop_services
 
 # Создаем lifespan manager для запуска бота
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Запускаем бота в фоновом режиме
-    task = asyncio.create_task(start_bot())  # Используем правильную функцию!
+    # Общий пул HTTP-соединений, журнал активности и другие фоновые службы
+    await start_services()
+    # В режиме longpoll запускаем бота в фоновом режиме, в режиме callback события придут на /callback
+    task = asyncio.create_task(start_bot()) if VK_MODE == 'longpoll' else None
     yield
     # Останавливаем бота при завершении
-    task.cancel()
-    try:
-        await task
-    except asyncio.CancelledError:
-        print("Бот остановлен")
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            print("Бот остановлен")
+    await stop_services()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -25,3 +31,31 @@ async def home():
 @app.get("/health")
 async def health():
     return {"status": "OK"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    # Формат Prometheus: гистограммы задержек команд, апстримов и загрузок в VK, счетчики кэшей
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/traces")
+async def traces_endpoint(request: Request, limit: int = 50, min_ms: float = 0):
+    # Последние трейсы событий VK, новые первыми; min_ms - только медленнее указанного.
+    # Только с токеном TRACES_TOKEN в заголовке X-Traces-Token или параметре token, без него эндпоинта нет
+    token = request.headers.get('X-Traces-Token') or request.query_params.get('token') or ''
+    if not TRACES_TOKEN or not hmac.compare_digest(token.encode(), TRACES_TOKEN.encode()):
+        return PlainTextResponse("not found", status_code=404)
+    return {"traces": export_traces(limit, min_ms / 1000)}
+
+
+@app.post("/callback", response_class=PlainTextResponse)
+async def callback_endpoint(request: Request):
+    # Callback API VK: подтверждение сервера, проверка секрета, событие уходит в роутер бота
+    if VK_MODE != 'callback':
+        return PlainTextResponse("callback mode is disabled", status_code=404)
+    try:
+        event = await request.json()
+    except ValueError:
+        return PlainTextResponse("bad request", status_code=400)
+    status, body = await handle_callback(event)
+    return PlainTextResponse(body, status_code=status)
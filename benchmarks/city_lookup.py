@@ -0,0 +1,51 @@
+# Микробенчмарк поиска города метеограммы: линейный проход по city_data (как было)
+# против индекса city_index.
+# Запуск из корня репозитория: python -m benchmarks.city_lookup
+import os
+import random
+import timeit
+
+os.environ.setdefault('VK_BOT_TOKEN', 'benchmark')
+os.environ.setdefault('ADMIN_ID', '0')
+
+from vk_bot import city_data, city_index  # noqa: E402
+
+REPEAT = 5
+NUMBER = 200
+
+
+# Прежний способ: upper() обоих названий на каждой строке
+def scan_lookup(name):
+    city_name = name.strip().upper()
+    return next((city for city in city_data if city['rus_name'].upper() == city_name or city['eng_name'].upper() == city_name), None)
+
+
+def index_lookup(name):
+    return city_index.get(name)
+
+
+def make_queries(count=10, seed=42):
+    rng = random.Random(seed)
+    hits = [city['rus_name'] for city in rng.sample(city_data, count)]
+    misses = ['Масква', 'Ленинские горки', 'Воскресенкс']
+    return hits, misses
+
+
+def bench(func, queries):
+    best = min(timeit.repeat(lambda: [func(name) for name in queries], repeat=REPEAT, number=NUMBER))
+    return best / (NUMBER * len(queries)) * 1e6  # мкс на один поиск
+
+
+def main():
+    hits, misses = make_queries()
+    print(f"Городов в city_data: {len(city_data)}")
+    for title, queries in (("найденные", hits), ("не найденные", misses)):
+        scan = bench(scan_lookup, queries)
+        index = bench(index_lookup, queries)
+        print(f"{title:>13}: перебор {scan:8.2f} мкс, индекс {index:6.2f} мкс, быстрее в {scan / index:.0f} раз")
+    suggest = bench(city_index.suggest, misses)
+    print(f"{'подсказки':>13}: {suggest:8.2f} мкс на запрос")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Микробенчмарк выбора команды в message_handler: словарь кортежей, который собирался
+# на каждое сообщение и перебирался по порядку (как было), против command_router.
+# Запуск из корня репозитория: python -m benchmarks.dispatch
+import os
+import timeit
+
+os.environ.setdefault('VK_BOT_TOKEN', 'benchmark')
+os.environ.setdefault('ADMIN_ID', '0')
+
+import vk_bot  # noqa: E402
+from vk_bot import route_command  # noqa: E402
+
+REPEAT = 5
+NUMBER = 2000
+
+
+# Прежний способ: словарь строится заново и перебирается для каждого сообщения
+def scan_dispatch(text):
+    v = vk_bot
+    text = text.lower()
+    commands = {
+        ("привет", "начать", "старт", "/start"): v.start_handler,
+        ("помощь", "help", "🚨помощь", "/help"): v.help_handler,
+        ("поддержать", "donate", "🎁поддержать", "/donate"): v.donate_handler,
+        ("поделиться ботом", "share", "📢поделиться ботом", "/share"): v.share_handler,
+        ("изменить город", "setcity", "✏️изменить город", "/setcity"): v.set_city_handler,
+        ("погода сейчас", "nowweather", "⛅погода сейчас", "/nowweather"): v.now_weather_handler,
+        ("погода на 3 дня", "forecastweather", "📆погода на 3 дня", "/forecastweather"): v.forecast_weather_handler,
+        ("качество воздуха", "aqi", "🌫️качество воздуха", "/aqi"): v.aqi_handler,
+        ("радар", "radarmap", "🗺️радар", "/radarmap"): v.radar_map_handler,
+        ("погода в аэропортах", "weatherairports", "✈️погода в аэропортах", "/weatherairports"): v.airport_weather_handler,
+        ("метеограммы гмц", "meteograms", "📊метеограммы гмц", "/meteograms"): v.meteograms_handler,
+        ("определить локацию", "location", "📍определить локацию"): v.location_handler,
+        ("угадать температуру", "guess_temp", "🎮угадать температуру", "/guess_temp"): v.guess_temp_handler,
+        ("метеостанции рф", "stations", "🚩метеостанции рф", "/stations"): v.stations_handler,
+        ("карты meteoweb", "get_meteoweb", "🌍карты meteoweb", "/get_meteoweb"): v.meteoweb_handler,
+        ("экстренная информация", "extrainfo", "❗экстренная информация", "/extrainfo"): v.extrainfo_handler,
+        ("поддержка", "support", "/support"): v.support_handler,
+        ("/precipitationmap",): v.precipitation_map_handler,
+        ("/anomaltempmap",): v.anomaly_temp_map_handler,
+        ("/tempwatermap",): v.temp_water_map_handler,
+        ("/verticaltemplayer",): v.vertical_temp_handler,
+        ("/firehazard_map",): v.fire_hazard_map_handler,
+        ("/alerts",): v.alerts_handler,
+        ("/weatherwebsites",): v.weather_websites_handler,
+    }
+    if text in ["статистика", "stats", "/stats"]:
+        return v.stats_handler
+    for cmd_tuple, cmd_handler in commands.items():
+        if text in cmd_tuple:
+            return cmd_handler
+    return None
+
+
+def router_dispatch(text):
+    return route_command(text)[0]
+
+
+# Кнопки меню, команды со слэшем и обычные реплики в беседах (их большинство в логе)
+QUERIES = {
+    'кнопки': ["⛅Погода сейчас", "🗺️Радар", "📆Погода на 3 дня", "🚨Помощь", "📊Метеограммы ГМЦ"],
+    'слэш': ["/nowweather", "/weatherwebsites", "/alerts", "/stations", "/start"],
+    'не команды': ["Всем привет!", "а у нас снег идет", "ок", "Москва", "кто-нибудь знает, будет дождь?"],
+}
+
+
+def bench(func, queries):
+    best = min(timeit.repeat(lambda: [func(text) for text in queries], repeat=REPEAT, number=NUMBER))
+    return best / (NUMBER * len(queries)) * 1e6  # мкс на одно сообщение
+
+
+def main():
+    print(f"Алиасов в command_router: {len(vk_bot.command_router)}")
+    for title, queries in QUERIES.items():
+        for text in queries:
+            assert scan_dispatch(text) is router_dispatch(text), text
+        scan = bench(scan_dispatch, queries)
+        router = bench(router_dispatch, queries)
+        print(f"{title:>11}: перебор {scan:6.2f} мкс, роутер {router:5.2f} мкс, быстрее в {scan / router:.1f} раз")
+    argument = bench(router_dispatch, ["погода Казань", "/aqi Berlin"])
+    print(f"{'с аргументом':>11}: роутер {argument:5.2f} мкс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# Локальная замена Redis для STATE_BACKEND=redis://: понимает протокол RESP и команды, которыми
+# пользуется бот (GET, SET с EX/PX/NX/XX, DEL), плюс PING, AUTH, SELECT, EXISTS, DBSIZE, FLUSHDB.
+# Данные в памяти процесса, истечение ключей ленивое. Годится для бенчмарков и нескольких воркеров
+# на одной машине, но не для продакшена.
+# Запуск из корня репозитория: python -m benchmarks.fake_redis [--port 6379],
+# затем STATE_BACKEND=redis://127.0.0.1:6379/0 uvicorn app:app --workers 4
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+
+class FakeRedis:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.data = {}  # (db, key) -> (expires_at или None, value)
+        self.calls = Counter()
+        self.clients = set()
+        self.server = None
+        self.url = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.url = f'redis://{self.host}:{self.port}/0'
+
+    async def stop(self):
+        self.server.close()
+        for writer in list(self.clients):
+            writer.close()
+        await self.server.wait_closed()
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    @staticmethod
+    async def read_command(reader):
+        line = await reader.readuntil(b'\r\n')
+        if not line.startswith(b'*'):
+            return line.strip().split()  # inline-команда, например из redis-cli или telnet
+        args = []
+        for _ in range(int(line[1:-2])):
+            size = int((await reader.readuntil(b'\r\n'))[1:-2])
+            args.append((await reader.readexactly(size + 2))[:-2])
+        return args
+
+    @staticmethod
+    def encode(reply):
+        if reply is None:
+            return b'$-1\r\n'
+        if isinstance(reply, int):
+            return b':%d\r\n' % reply
+        if isinstance(reply, bytes):
+            return b'$%d\r\n%s\r\n' % (len(reply), reply)
+        if isinstance(reply, Exception):
+            return f'-ERR {reply}\r\n'.encode()
+        return f'+{reply}\r\n'.encode()
+
+    async def serve(self, reader, writer):
+        db = 0
+        self.clients.add(writer)
+        try:
+            while True:
+                args = await self.read_command(reader)
+                if not args:
+                    continue
+                name = args[0].decode().upper()
+                self.calls[name] += 1
+                if name == 'SELECT':
+                    db = int(args[1])
+                    reply = 'OK'
+                elif name == 'QUIT':
+                    writer.write(self.encode('OK'))
+                    break
+                else:
+                    try:
+                        reply = self.execute(db, name, args[1:])
+                    except (IndexError, ValueError) as e:
+                        reply = ValueError(f"wrong arguments for '{name}': {e}")
+                writer.write(self.encode(reply))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    def alive(self, key):
+        entry = self.data.get(key)
+        if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+            del self.data[key]
+            return None
+        return entry
+
+    def execute(self, db, name, args):
+        if name == 'PING':
+            return 'PONG'
+        if name == 'AUTH':
+            return 'OK'
+        if name == 'GET':
+            entry = self.alive((db, args[0]))
+            return entry[1] if entry is not None else None
+        if name == 'SET':
+            key, value, options = (db, args[0]), args[1], [arg.decode().upper() for arg in args[2:]]
+            expires_at = None
+            if 'EX' in options:
+                expires_at = time.monotonic() + int(options[options.index('EX') + 1])
+            if 'PX' in options:
+                expires_at = time.monotonic() + int(options[options.index('PX') + 1]) / 1000
+            exists = self.alive(key) is not None
+            if ('NX' in options and exists) or ('XX' in options and not exists):
+                return None
+            self.data[key] = (expires_at, value)
+            return 'OK'
+        if name in ('DEL', 'EXISTS'):
+            found = [key for key in ((db, arg) for arg in args) if self.alive(key) is not None]
+            if name == 'DEL':
+                for key in found:
+                    del self.data[key]
+            return len(found)
+        if name == 'DBSIZE':
+            return sum(1 for key in list(self.data) if key[0] == db and self.alive(key) is not None)
+        if name == 'FLUSHDB':
+            for key in [key for key in self.data if key[0] == db]:
+                del self.data[key]
+            return 'OK'
+        return ValueError(f"unknown command '{name}'")
+
+
+async def serve_forever(args):
+    server = FakeRedis(args.host, args.port)
+    await server.start()
+    print(f"Слушаю {server.url}")
+    await server.server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Redis (RESP) для STATE_BACKEND")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    try:
+        asyncio.run(serve_forever(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,448 @@
+# Нагрузочный бенчмарк без сети: бот получает сообщения через long poll от локальной заглушки VK API
+# (long poll, messages.send, загрузка фото) и ходит в локальные заглушки weatherapi.com, meteoinfo.ru
+# и metartaf.ru с настраиваемой задержкой. Смесь команд, города пользователей и задержки берутся
+# из генератора с фиксированным seed, так что прогоны с одними параметрами сравнимы между собой.
+# Отчет: сообщений в секунду, p50/p95/p99 по командам, запросов к апстримам и к VK на сообщение.
+# Запуск из корня репозитория: python -m benchmarks.offline [--messages 400] [--users 20] [--state-backend redis]
+import argparse
+import asyncio
+import contextlib
+import importlib
+import io
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+
+from aiohttp import web
+from PIL import Image
+
+from benchmarks.fake_redis import FakeRedis
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# Сценарии: (название, вес в смеси, сообщения по порядку). Время считается для последнего сообщения:
+# от отправки события в long poll до первого messages.send этому пользователю.
+SCENARIOS = [
+    ('/help', 2, ["/help"]),
+    ('/nowweather', 6, ["⛅Погода сейчас"]),
+    ('/forecastweather', 3, ["📆Погода на 3 дня"]),
+    ('/aqi', 1, ["/aqi"]),
+    ('/alerts', 1, ["/alerts"]),
+    ('погода <город>', 2, ["погода {city}"]),
+    ('/precipitationmap', 2, ["/precipitationmap"]),
+    ('/anomaltempmap', 1, ["/anomaltempmap"]),
+    ('/extrainfo', 1, ["/extrainfo"]),
+    ('/weatherairports', 2, ["✈️Погода в аэропортах", "{airport}"]),
+    ('/stations', 1, ["/stations", "московская область", "клин"]),
+]
+AIRPORTS = ['UUEE', 'UUDD', 'UUWW', 'ULLI', 'URSS', 'USSS', 'UWKD', 'UNNT']
+
+EXTRAINFO_PAGE = """<html><head><meta charset="utf-8"></head><body>
+<div class="container page-header"><h1>Экстренная информация</h1></div>
+<div id="div_1"><table>
+<tr><td>17.10</td><td><b>Москва</b>: сильный ветер 15-20 м/с</td></tr>
+<tr><td>18.10</td><td>Гроза, град</td></tr></table></div>
+<div id="div_2"><table><tr><td>Консультативная информация</td></tr></table></div>
+</body></html>"""
+STATION_PAGE = """<html><body><table><tr><td colspan="2" align="right">Погода в {time} (МСК) {date}</td></tr></table>
+<table border="0" style="width:100%">
+<tr><td>Температура воздуха, °C</td><td>{temp}</td></tr>
+<tr><td>Атмосферное давление на уровне станции, мм рт.ст.</td><td>{pressure}</td></tr>
+<tr><td>Средняя скорость ветра, м/с</td><td>3</td></tr>
+<tr><td>Направление ветра</td><td>Северо-западный</td></tr>
+<tr><td>Относительная влажность, %</td><td>81</td></tr>
+</table></body></html>"""
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def make_image(size, fmt, seed):
+    # Шум, чтобы PNG не сжимался в несколько байт и загрузка весила как настоящая карта
+    rng = random.Random(seed)
+    image = Image.frombytes('L', (size, size), bytes(rng.getrandbits(8) for _ in range(size * size)))
+    output = io.BytesIO()
+    if fmt == 'GIF':
+        frames = [image.convert('P')] + [image.rotate(90 * i).convert('P') for i in range(1, 3)]
+        frames[0].save(output, format='GIF', save_all=True, append_images=frames[1:], duration=200)
+    else:
+        image.convert('RGB').save(output, format=fmt)
+    return output.getvalue()
+
+
+class StubServer:
+    # Локальный HTTP-сервер с задержкой ответа uniform(latency * (1 - jitter), latency * (1 + jitter))
+    def __init__(self, name, latency, jitter, seed):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.runner = None
+        self.base_url = None
+
+    async def delay(self, label):
+        self.calls[label] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * self.rng.uniform(1 - self.jitter, 1 + self.jitter))
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f'http://127.0.0.1:{port}'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+
+class FakeVK(StubServer):
+    def __init__(self, latency, jitter, seed):
+        super().__init__('vk', latency, jitter, seed)
+        self.events = asyncio.Queue()
+        self.waiters = {}  # peer_id -> future первого ответа
+        self.on_send = None  # необязательный колбэк (peer_id, текст, время) на каждый messages.send
+        self.sent = 0
+        self.next_id = 1
+        self.app.router.add_post('/method/{name}', self.method)
+        self.app.router.add_post('/upload', self.upload)
+        self.app.router.add_post('/lp', self.long_poll)
+
+    def response(self, name, data):
+        if name == 'groups.getLongPollServer':
+            return {'key': 'key', 'server': f'{self.base_url}/lp', 'ts': '1'}
+        if name in ('photos.getMessagesUploadServer', 'docs.getMessagesUploadServer'):
+            return {'upload_url': f'{self.base_url}/upload', 'album_id': -3, 'user_id': 0}
+        if name == 'photos.saveMessagesPhoto':
+            self.next_id += 1
+            return [{'id': self.next_id, 'owner_id': -1, 'album_id': -3, 'date': 0, 'sizes': []}]
+        if name == 'docs.save':
+            self.next_id += 1
+            return {'type': 'doc', 'doc': {'id': self.next_id, 'owner_id': -1}}
+        if name == 'messages.send':
+            # message.answer() шлет peer_ids и ждет список, bot.api.messages.send - peer_id и число
+            peer_ids = [int(peer) for peer in str(data.get('peer_ids') or data.get('peer_id', 0)).split(',')]
+            now = time.perf_counter()
+            for peer_id in peer_ids:
+                self.sent += 1
+                waiter = self.waiters.pop(peer_id, None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(now)
+                if self.on_send is not None:
+                    self.on_send(peer_id, data.get('message', ''), now)
+            if 'peer_ids' in data:
+                return [{'peer_id': peer, 'message_id': self.sent, 'conversation_message_id': self.sent} for peer in peer_ids]
+            return self.sent
+        return 1
+
+    async def method(self, request):
+        name = request.match_info['name']
+        data = await request.post()
+        await self.delay(name)
+        return web.json_response({'response': self.response(name, data)})
+
+    async def upload(self, request):
+        await request.read()
+        await self.delay('upload')
+        return web.json_response({'server': 1, 'photo': '[{"photo":"x"}]', 'hash': 'hash', 'file': 'file'})
+
+    async def long_poll(self, request):
+        try:
+            updates = [await asyncio.wait_for(self.events.get(), timeout=1)]
+        except asyncio.TimeoutError:
+            updates = []
+        while not self.events.empty():
+            updates.append(self.events.get_nowait())
+        return web.json_response({'ts': str(self.next_id), 'updates': updates})
+
+    def push_message(self, user_id, text, peer_id=None, wait=True):
+        peer_id = peer_id or user_id
+        self.next_id += 1
+        waiter = None
+        if wait:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters[peer_id] = waiter
+        self.events.put_nowait({
+            'type': 'message_new',
+            'event_id': f'bench{self.next_id}',
+            'group_id': 1,
+            'v': '5.131',
+            'object': {
+                'message': {
+                    'id': self.next_id, 'date': int(time.time()), 'peer_id': peer_id, 'from_id': user_id,
+                    'text': text, 'conversation_message_id': self.next_id, 'out': 0, 'random_id': 0,
+                    'attachments': [], 'fwd_messages': [], 'important': False, 'is_hidden': False,
+                },
+                'client_info': {
+                    'button_actions': ['text', 'callback', 'open_link', 'location'],
+                    'keyboard': True, 'inline_keyboard': True, 'carousel': True, 'lang_id': 0,
+                },
+            },
+        })
+        return time.perf_counter(), waiter
+
+
+class FakeWeatherAPI(StubServer):
+    def __init__(self, latency, jitter, seed):
+        super().__init__('api.weatherapi.com', latency, jitter, seed)
+        self.app.router.add_get('/v1/{endpoint}', self.handle)
+
+    @staticmethod
+    def forecast(city):
+        now = datetime.now(timezone.utc)
+        day = {
+            'maxtemp_c': 9.1, 'mintemp_c': 2.0, 'maxwind_kph': 20.0, 'totalprecip_mm': 1.2,
+            'condition': {'text': 'Дождь', 'code': 1183},
+        }
+        return {
+            'location': {'name': city, 'country': 'Россия', 'localtime': now.strftime('%Y-%m-%d %H:%M')},
+            'current': {
+                'last_updated': now.strftime('%Y-%m-%d %H:%M'), 'temp_c': 7.0, 'feelslike_c': 4.1,
+                'wind_kph': 14.4, 'wind_dir': 'NW', 'humidity': 81, 'cloud': 75, 'pressure_mb': 1012.0,
+                'uv': 1.0, 'vis_km': 10.0, 'condition': {'text': 'Облачно', 'code': 1006},
+                'air_quality': {'co': 230.3, 'no2': 12.1, 'o3': 40.0, 'so2': 3.2, 'pm2_5': 5.5, 'pm10': 7.1, 'us-epa-index': 1},
+            },
+            'forecast': {'forecastday': [
+                {'date': now.strftime('%Y-%m-%d'), 'day': day, 'astro': {'sunrise': '07:12 AM', 'sunset': '05:40 PM'}}
+                for _ in range(3)
+            ]},
+            'alerts': {'alert': [{
+                'event': 'Ветер', 'desc': 'Сильный ветер',
+                'effective': now.isoformat(), 'expires': now.isoformat(),
+            }]},
+        }
+
+    async def handle(self, request):
+        endpoint = request.match_info['endpoint']
+        await self.delay(endpoint)
+        city = request.query.get('q', '')
+        if endpoint == 'search.json':
+            return web.json_response([{'name': city}])
+        return web.json_response(self.forecast(city))
+
+
+class FakeMeteoinfo(StubServer):
+    def __init__(self, latency, jitter, seed, image_size):
+        super().__init__('meteoinfo.ru', latency, jitter, seed)
+        self.images = {
+            '.png': make_image(image_size, 'PNG', seed),
+            '.jpg': make_image(image_size, 'JPEG', seed),
+            '.gif': make_image(image_size // 2, 'GIF', seed),
+        }
+        self.app.router.add_get('/{path:.*}', self.handle)
+
+    async def handle(self, request):
+        path = request.match_info['path']
+        await self.delay(path.rsplit('/', 1)[-1] if '.' in path else path.split('/', 1)[0])
+        extension = os.path.splitext(path)[1]
+        if extension in self.images:
+            etag = f'"{extension[1:]}"'
+            if request.headers.get('If-None-Match') == etag:
+                return web.Response(status=304)
+            return web.Response(body=self.images[extension], headers={'ETag': etag})
+        if path == 'extrainfopage':
+            return web.Response(text=EXTRAINFO_PAGE, content_type='text/html')
+        now = datetime.now(timezone.utc)
+        page = STATION_PAGE.format(
+            time=now.strftime('%H:00'), date=now.strftime('%d.%m.%Y'),
+            temp=round(self.rng.uniform(-5, 15), 1), pressure=round(self.rng.uniform(735, 760), 1),
+        )
+        return web.Response(text=page, content_type='text/html')
+
+
+class FakeMetartaf(StubServer):
+    def __init__(self, latency, jitter, seed):
+        super().__init__('metartaf.ru', latency, jitter, seed)
+        self.app.router.add_get('/{code}.json', self.handle)
+
+    async def handle(self, request):
+        code = request.match_info['code']
+        await self.delay(code)
+        issued = datetime.now(timezone.utc).strftime('%d%H%MZ')
+        return web.json_response({
+            'icao': code, 'name': code,
+            'metar': f'METAR {code} {issued} 18005MPS 9999 SCT030 07/03 Q1012 NOSIG',
+            'taf': f'TAF {code} {issued} 1712/1818 18005MPS 9999 BKN020',
+        })
+
+
+async def run_user(vk, rng, user_id, city, scenarios, weights, count, results, args):
+    vk_bot = sys.modules['vk_bot']
+    await vk_bot.save_city(user_id, city)
+    for _ in range(count):
+        name, _, messages = rng.choices(scenarios, weights=weights)[0]
+        airport = rng.choice(AIRPORTS)
+        for step, text in enumerate(messages):
+            if step:
+                # Бот ставит обработчик диалога после ответа: без паузы следующий шаг может его обогнать
+                await asyncio.sleep(args.think_time)
+            started, waiter = vk.push_message(user_id, text.format(city=city, airport=airport))
+            try:
+                finished = await asyncio.wait_for(waiter, args.timeout)
+                latency = finished - started
+            except asyncio.TimeoutError:
+                vk.waiters.pop(user_id, None)
+                latency = None
+            if latency is None:
+                break
+        results[name].append(latency)
+
+
+# Заглушки VK и апстримов вокруг настоящего vk_bot; используется и в benchmarks/replay.py
+class StubStand:
+    def __init__(self, args):
+        self.args = args
+        self.vk = FakeVK(args.vk_latency / 1000, args.jitter, args.seed)
+        self.upstreams = [
+            FakeWeatherAPI(args.weather_latency / 1000, args.jitter, args.seed + 1),
+            FakeMeteoinfo(args.meteoinfo_latency / 1000, args.jitter, args.seed + 2, args.image_size),
+            FakeMetartaf(args.metartaf_latency / 1000, args.jitter, args.seed + 3),
+        ]
+        self.redis = FakeRedis() if args.state_backend == 'redis' else None
+        self.vk_bot = None
+        self.polling = None
+
+    async def start(self):
+        # Бэкенд состояния выбирается при импорте бота
+        if self.redis is not None:
+            await self.redis.start()
+            os.environ['STATE_BACKEND'] = self.redis.url
+        elif self.args.state_backend == 'sqlite':
+            os.environ['STATE_BACKEND'] = 'sqlite:///state.db'
+        else:
+            os.environ['STATE_BACKEND'] = 'memory'
+        vk_bot = self.vk_bot = importlib.import_module('vk_bot')
+        logging.getLogger('vkbottle').setLevel(logging.WARNING)
+        await self.vk.start()
+        for server in self.upstreams:
+            await server.start()
+            vk_bot.upstream_overrides[server.name] = server.base_url
+        if not self.args.flood_limit:
+            # Виртуальный пользователь пишет чаще живого: с антифлудом мерили бы блокировки, а не бота
+            vk_bot.rate_limiter = vk_bot.RateLimiter(vk_bot.state_backend, capacity=10 ** 9)
+        vk_bot.bot.api.API_URL = f'{self.vk.base_url}/method/'
+        vk_bot.bot.polling.group_id = 1
+        await vk_bot.open_http_session()
+        self.polling = asyncio.create_task(vk_bot.bot.run_polling())
+        return vk_bot
+
+    async def stop(self):
+        self.vk_bot.bot.polling.stop = True
+        self.polling.cancel()
+        await asyncio.gather(self.polling, return_exceptions=True)
+        await self.vk_bot.close_http_session()
+        await self.vk_bot.state_backend.close()
+        self.vk_bot.shutdown_image_executor()
+        for server in [self.vk] + self.upstreams:
+            await server.stop()
+        if self.redis is not None:
+            await self.redis.stop()
+
+    def print_calls(self, messages):
+        print("Запросов на сообщение:")
+        for server in self.upstreams:
+            print(f"  {server.name:<20}{server.total_calls() / messages:6.3f}  {dict(server.calls.most_common(5))}")
+        print(f"  {'VK API':<20}{self.vk.total_calls() / messages:6.3f}  {dict(self.vk.calls.most_common(6))}")
+        if self.redis is not None:
+            print(f"  {'redis':<20}{self.redis.total_calls() / messages:6.3f}  {dict(self.redis.calls)}")
+
+
+async def run(args):
+    stand = StubStand(args)
+    vk_bot = await stand.start()
+    vk = stand.vk
+
+    rng = random.Random(args.seed)
+    cities = [city['rus_name'].replace('_', ' ') for city in rng.sample(vk_bot.city_data, args.cities)]
+    weights = [weight for _, weight, _ in SCENARIOS]
+    per_user = max(1, args.messages // args.users)
+    results = defaultdict(list)
+    users = [
+        run_user(vk, random.Random(args.seed * 1000 + n), 100000 + n, rng.choice(cities),
+                 SCENARIOS, weights, per_user, results, args)
+        for n in range(args.users)
+    ]
+
+    started = time.perf_counter()
+    # Бот печатает каждое событие и ошибки в stdout: на время прогона глушим, чтобы не мерить терминал
+    with contextlib.redirect_stdout(io.StringIO()) as bot_output:
+        await asyncio.gather(*users)
+    elapsed = time.perf_counter() - started
+
+    await stand.stop()
+
+    messages = sum(
+        len(messages) * len(results[name]) for name, _, messages in SCENARIOS if name in results
+    )
+    errors = bot_output.getvalue().count('[ERROR]')
+    print(f"seed={args.seed} users={args.users} cities={args.cities} latency(ms): vk={args.vk_latency} "
+          f"weather={args.weather_latency} meteoinfo={args.meteoinfo_latency} metartaf={args.metartaf_latency}")
+    print(f"Сообщений: {messages} за {elapsed:.2f} с -> {messages / elapsed:.1f} сообщ/с, [ERROR] в логе бота: {errors}")
+    print(f"{'команда':<20}{'n':>6}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'таймаут':>9}")
+    for name, _, _ in SCENARIOS:
+        latencies = [value * 1000 for value in results.get(name, []) if value is not None]
+        timeouts = sum(value is None for value in results.get(name, []))
+        print(f"{name:<20}{len(latencies):>6}{percentile(latencies, 50):>10.1f}"
+              f"{percentile(latencies, 95):>10.1f}{percentile(latencies, 99):>10.1f}{timeouts:>9}")
+    stand.print_calls(messages)
+
+
+def add_stand_arguments(parser):
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--vk-latency', type=float, default=20, help='мс')
+    parser.add_argument('--weather-latency', type=float, default=80, help='мс')
+    parser.add_argument('--meteoinfo-latency', type=float, default=120, help='мс')
+    parser.add_argument('--metartaf-latency', type=float, default=60, help='мс')
+    parser.add_argument('--jitter', type=float, default=0.5, help='доля разброса задержки')
+    parser.add_argument('--image-size', type=int, default=600, help='сторона картинок meteoinfo, px')
+    parser.add_argument('--flood-limit', action='store_true', help='не отключать антифлуд бота')
+    parser.add_argument('--state-backend', choices=('memory', 'sqlite', 'redis'), default='memory',
+                        help='где бот хранит состояние; redis - локальная заглушка benchmarks/fake_redis.py')
+    parser.add_argument('--cities', type=int, default=20, help='разных городов у пользователей')
+
+
+def run_in_workdir(coroutine_function, args):
+    os.environ.setdefault('VK_BOT_TOKEN', 'benchmark')
+    os.environ.setdefault('ADMIN_ID', '0')
+    os.environ.setdefault('WEATHER_API_KEY', 'benchmark')
+    # Бот пишет статистику, наблюдения станций и state.db в текущий каталог: работаем во временном
+    workdir = tempfile.mkdtemp(prefix='pogodaradar-bench-')
+    shutil.copy(ROOT / 'city_data.csv', workdir)
+    sys.path.insert(0, str(ROOT))
+    os.chdir(workdir)
+    try:
+        asyncio.run(coroutine_function(args))
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота на локальных заглушках VK и апстримов")
+    parser.add_argument('--messages', type=int, default=400, help='сколько сценариев прогнать всего')
+    parser.add_argument('--users', type=int, default=20, help='одновременных пользователей')
+    parser.add_argument('--timeout', type=float, default=30, help='ожидание ответа бота, с')
+    parser.add_argument('--think-time', type=float, default=0.05, help='пауза между шагами диалога, с')
+    add_stand_arguments(parser)
+    run_in_workdir(run, parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+# Воспроизведение реального трафика из user_statistics.csv (или синтетического, собранного из того же
+# набора сообщений) событиями message_new через заглушку VK из benchmarks/offline.py.
+# Время: как в логе (--timing original, --speed ускоряет), с постоянной частотой (--timing constant --rate).
+# Отчет: задержка и исходы по командам (ответ, ответ с ошибкой, блокировка, без ответа) и задержки цикла событий.
+# Запуск из корня репозитория: python -m benchmarks.replay [--synthetic 2000 --users 200 --timing constant --rate 50]
+import argparse
+import asyncio
+import contextlib
+import csv
+import io
+import random
+import re
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from benchmarks.offline import ROOT, StubStand, add_stand_arguments, percentile, run_in_workdir
+
+CHAT_ACTION_RE = re.compile(r'^\[Беседа (\d+)\] (.*)$', re.S)
+ACTION_PREFIXES = ('Сообщение: ', 'Команда: ')
+LAG_INTERVAL = 0.01  # как часто проверять задержку цикла событий, сек
+ERROR_MARKERS = ('⚠️ Произошла', 'Ошибка', 'Не удалось', 'ошибка')
+NOT_A_COMMAND = 'не команда'
+
+
+def parse_action(user_id, action):
+    # -> (peer_id, текст сообщения)
+    match = CHAT_ACTION_RE.match(action)
+    if match:
+        return int(match.group(1)), match.group(2)
+    for prefix in ACTION_PREFIXES:
+        if action.startswith(prefix):
+            return user_id, action[len(prefix):]
+    return user_id, action
+
+
+def load_log(path):
+    events = []
+    with open(path, mode='r', encoding='utf-8') as file:
+        for row in csv.reader(file):
+            if len(row) < 4 or not row[0].lstrip('-').isdigit():
+                continue
+            try:
+                timestamp = datetime.strptime(row[3], '%Y-%m-%d %H:%M:%S').timestamp()
+            except ValueError:
+                continue
+            user_id = int(row[0])
+            peer_id, text = parse_action(user_id, row[2])
+            if text.strip():
+                events.append((timestamp, user_id, peer_id, text))
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def synthesize(events, count, users, rng):
+    # Та же смесь сообщений и та же доля бесед, но count событий от users пользователей
+    chat_share = sum(peer_id != user_id for _, user_id, peer_id, _ in events) / len(events)
+    texts = [text for _, _, _, text in events]
+    chats = [2000000000 + n for n in range(1, max(2, users // 20) + 1)]
+    result = []
+    for n in range(count):
+        user_id = 1000000 + rng.randrange(users)
+        peer_id = rng.choice(chats) if rng.random() < chat_share else user_id
+        result.append((n, user_id, peer_id, rng.choice(texts)))
+    return result
+
+
+def schedule(events, args, rng):
+    # -> [(задержка от начала прогона в секундах, user_id, peer_id, текст)]
+    if args.timing == 'constant':
+        return [(n / args.rate, user_id, peer_id, text) for n, (_, user_id, peer_id, text) in enumerate(events)]
+    offsets = []
+    offset = 0.0
+    previous = events[0][0]
+    for timestamp, user_id, peer_id, text in events:
+        gap = (timestamp - previous) / args.speed
+        if args.max_gap is not None:
+            gap = min(gap, args.max_gap)
+        if args.timing == 'poisson' and gap:
+            gap = rng.expovariate(1 / gap)
+        offset += gap
+        previous = timestamp
+        offsets.append((offset, user_id, peer_id, text))
+    return offsets
+
+
+class ReplayRecorder:
+    def __init__(self, vk_bot, timeout):
+        self.vk_bot = vk_bot
+        self.timeout = timeout
+        self.pending = defaultdict(list)  # peer_id -> [(команда, время отправки)]
+        self.latencies = defaultdict(list)
+        self.outcomes = defaultdict(Counter)
+
+    async def label(self, user_id, text):
+        # Команда по роутеру бота; ввод внутри диалога - по состоянию диалога пользователя
+        state, _ = await self.vk_bot.get_dialog(user_id)
+        if state is not None:
+            return f"ввод: {state.name}"
+        handler, argument = self.vk_bot.route_command(text)
+        if handler is None:
+            return NOT_A_COMMAND
+        return handler.__name__ + (' <аргумент>' if argument else '')
+
+    def sent(self, peer_id, command, started):
+        self.pending[peer_id].append((command, started))
+
+    def on_send(self, peer_id, text, finished):
+        # Ответ относим к самой старой команде в этом чате, если ее нет - к последнему сообщению.
+        # Команды с несколькими сообщениями в ответ при сильном ускорении могут исказить разбивку.
+        pending = self.pending.get(peer_id)
+        if not pending:
+            return
+        index = next((n for n, (command, _) in enumerate(pending) if command != NOT_A_COMMAND), len(pending) - 1)
+        command, started = pending.pop(index)
+        self.latencies[command].append(finished - started)
+        if 'заблокированы' in text:
+            self.outcomes[command]['блокировка'] += 1
+        elif any(marker in text for marker in ERROR_MARKERS):
+            self.outcomes[command]['ошибка'] += 1
+        else:
+            self.outcomes[command]['ответ'] += 1
+
+    def expire(self, now=None):
+        now = now if now is not None else time.perf_counter()
+        for peer_id, pending in self.pending.items():
+            fresh = []
+            for command, started in pending:
+                if now - started > self.timeout:
+                    self.outcomes[command]['без ответа'] += 1
+                else:
+                    fresh.append((command, started))
+            pending[:] = fresh
+
+    def waiting_for_replies(self):
+        return any(command != NOT_A_COMMAND for pending in self.pending.values() for command, _ in pending)
+
+
+async def monitor_loop_lag(samples, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append(time.perf_counter() - started - LAG_INTERVAL)
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    events = load_log(args.log)
+    if args.synthetic:
+        events = synthesize(events, args.synthetic, args.users, rng)
+    planned = schedule(events, args, rng)
+
+    stand = StubStand(args)
+    vk_bot = await stand.start()
+    recorder = ReplayRecorder(vk_bot, args.timeout)
+    stand.vk.on_send = recorder.on_send
+    cities = [city['rus_name'].replace('_', ' ') for city in rng.sample(vk_bot.city_data, args.cities)]
+    for user_id in sorted({user_id for _, user_id, _, _ in planned}):
+        await vk_bot.save_city(user_id, rng.choice(cities))
+
+    lag_samples = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(monitor_loop_lag(lag_samples, stop))
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()) as bot_output:
+        for offset, user_id, peer_id, text in planned:
+            delay = started + offset - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            recorder.sent(peer_id, await recorder.label(user_id, text), time.perf_counter())
+            stand.vk.push_message(user_id, text, peer_id=peer_id, wait=False)
+            recorder.expire()
+        sending = time.perf_counter() - started
+        # Ждем ответы на последние команды (на обычные реплики бот не отвечает)
+        deadline = time.perf_counter() + args.timeout
+        while recorder.waiting_for_replies() and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        recorder.expire(float('inf'))
+    stop.set()
+    await monitor
+    await stand.stop()
+
+    errors = bot_output.getvalue().count('[ERROR]')
+    print(f"seed={args.seed} timing={args.timing} speed={args.speed} rate={args.rate} "
+          f"synthetic={args.synthetic or 'нет'} events={len(planned)}")
+    print(f"Событий: {len(planned)} за {sending:.2f} с -> {len(planned) / sending:.1f} событий/с, "
+          f"[ERROR] в логе бота: {errors}")
+    print(f"{'команда':<38}{'n':>6}{'p50, мс':>9}{'p95, мс':>9}{'p99, мс':>9}  исходы")
+    commands = sorted(recorder.outcomes, key=lambda command: -sum(recorder.outcomes[command].values()))
+    for command in commands:
+        latencies = [value * 1000 for value in recorder.latencies[command]]
+        total = sum(recorder.outcomes[command].values())
+        outcomes = ', '.join(f"{name} {count}" for name, count in recorder.outcomes[command].most_common())
+        print(f"{command:<38}{total:>6}{percentile(latencies, 50):>9.1f}{percentile(latencies, 95):>9.1f}"
+              f"{percentile(latencies, 99):>9.1f}  {outcomes}")
+    lag = [value * 1000 for value in lag_samples]
+    print(f"Задержка цикла событий, мс: p50 {percentile(lag, 50):.2f}, p99 {percentile(lag, 99):.2f}, "
+          f"макс {max(lag, default=0):.2f}")
+    stand.print_calls(len(planned))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение трафика из user_statistics.csv на заглушках")
+    parser.add_argument('--log', default=str(ROOT / 'user_statistics.csv'))
+    parser.add_argument('--timing', choices=('original', 'poisson', 'constant'), default='original',
+                        help='original - интервалы из лога, poisson - случайные со средним из лога, constant - --rate')
+    parser.add_argument('--speed', type=float, default=1000, help='во сколько раз ускорить интервалы из лога')
+    parser.add_argument('--max-gap', type=float, default=2, help='наибольшая пауза после ускорения, с')
+    parser.add_argument('--rate', type=float, default=20, help='событий в секунду для --timing constant')
+    parser.add_argument('--synthetic', type=int, default=0, help='сгенерировать столько событий по смеси из лога')
+    parser.add_argument('--users', type=int, default=100, help='пользователей в синтетическом трафике')
+    parser.add_argument('--timeout', type=float, default=10, help='сколько ждать ответа, с')
+    add_stand_arguments(parser)
+    run_in_workdir(run, parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,20 @@ import random
 import time
 import csv
 import re
+import hashlib
+import hmac
+import abc
 import concurrent.futures
-from datetime import datetime, timedelta
-from bs4 import BeautifulSoup
+import multiprocessing
+import contextlib
+import contextvars
+import itertools
+import bisect
+import math
+from array import array
+from collections import OrderedDict, Counter, deque
+from datetime import datetime, timedelta, timezone
+import lxml.html
 from dotenv import load_dotenv
 from vkbottle import Bot
 from vkbottle.bot import Message
@@ -16,13 +27,14 @@ from vkbottle import Keyboard, KeyboardButtonColor, Text, OpenLink, Callback
 from vkbottle import TemplateElement
 from vkbottle import EMPTY_KEYBOARD
 from vkbottle.dispatch.rules.base import GeoRule
-from io import BytesIO
-from PIL import Image, ImageSequence
+from io import BytesIO, StringIO
+from PIL import Image, ImageSequence, ImageDraw, ImageFont
 import aiohttp
+import yarl
 from aiohttp import ClientTimeout
 import logging
-import typing
 import json
+import sqlite3
 import asyncio
 
 logging.getLogger("vkbottle").setLevel(logging.INFO)
@@ -30,8 +42,6 @@ logging.getLogger("vkbottle").setLevel(logging.INFO)
 # Load environment variables
 load_dotenv()
 
-user_game_states = {}  # Для хранения состояний игр пользователей
-
 # Get VK token and check its presence
 VK_BOT_TOKEN = os.getenv('VK_BOT_TOKEN')
 if not VK_BOT_TOKEN:
@@ -46,9 +56,42 @@ try:
 except ValueError:
     raise ValueError("Error: ADMIN_ID must be an integer")
 
+# Способ получения событий: longpoll (по умолчанию) или callback - VK сам шлет события POST-запросом
+# на /callback веб-приложения (app.py); так можно запускать несколько воркеров uvicorn за балансировщиком
+VK_MODE = os.getenv('VK_MODE', 'longpoll').lower()
+if VK_MODE not in ('longpoll', 'callback'):
+    raise ValueError("Error: VK_MODE must be 'longpoll' or 'callback'")
+VK_CALLBACK_CONFIRMATION = os.getenv('VK_CALLBACK_CONFIRMATION')  # строка из настроек Callback API группы
+VK_CALLBACK_SECRET = os.getenv('VK_CALLBACK_SECRET')  # секретный ключ оттуда же
+VK_GROUP_ID = os.getenv('VK_GROUP_ID')
+if VK_MODE == 'callback' and not VK_CALLBACK_CONFIRMATION:
+    raise ValueError("Error: VK_CALLBACK_CONFIRMATION not set in environment variables (.env file)")
+# Без секрета любой, кто знает адрес, может прислать поддельное событие от имени любого пользователя
+if VK_MODE == 'callback' and not VK_CALLBACK_SECRET:
+    raise ValueError("Error: VK_CALLBACK_SECRET not set in environment variables (.env file)")
+try:
+    VK_GROUP_ID = int(VK_GROUP_ID) if VK_GROUP_ID else None
+except ValueError:
+    raise ValueError("Error: VK_GROUP_ID must be an integer")
+
 # Create bot only if token is valid
 bot = Bot(token=VK_BOT_TOKEN)
 
+
+# Трейс на каждое событие и спан на каждый вызов VK API (отправка, загрузки); см. start_trace ниже
+async def traced_route(event, ctx_api, route=bot.router.route):
+    with start_trace('event', **event_trace_attrs(event)):
+        return await route(event, ctx_api)
+
+
+async def traced_api_request(method, data, request=bot.api.request):
+    with trace_span('vk', method=method):
+        return await request(method, data)
+
+
+bot.router.route = traced_route
+bot.api.request = traced_api_request
+
 # Weather API configuration
 weather_url = 'http://api.weatherapi.com/v1'
 api_key = os.getenv('WEATHER_API_KEY')
@@ -59,73 +102,1064 @@ async def message_handler(event: dict):
     # Ваш основной код обработки сообщений
     print("Новое сообщение:", event)
 
+# Общий HTTP-клиент: одна сессия на процесс, открывается и закрывается из lifespan в app.py
+HTTP_POOL_LIMIT = 100  # всего соединений
+HTTP_POOL_LIMIT_PER_HOST = 10  # соединений на один хост
+HTTP_KEEPALIVE_TIMEOUT = 60  # сколько держать простаивающее соединение, сек
+HTTP_DNS_CACHE_TTL = 600  # сек
+
+# Таймауты по апстримам (хост -> ClientTimeout)
+UPSTREAM_TIMEOUTS = {
+    'api.weatherapi.com': ClientTimeout(total=10, connect=5),
+    'meteoinfo.ru': ClientTimeout(total=10, connect=5),
+    '193.7.160.230': ClientTimeout(total=30, connect=10),  # метеограммы ГМЦ
+    'metartaf.ru': ClientTimeout(total=10, connect=5),
+}
+DEFAULT_TIMEOUT = ClientTimeout(total=15, connect=5)
+
+http_session = None
+
+
+async def open_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        )
+        http_session = aiohttp.ClientSession(connector=connector, timeout=DEFAULT_TIMEOUT)
+    return http_session
+
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+
+async def get_http_session():
+    # Если бот запущен без app.py (без lifespan), сессия создается при первом запросе
+    if http_session is None or http_session.closed:
+        return await open_http_session()
+    return http_session
+
+
+def get_timeout(url):
+    host = yarl.URL(url).host
+    return UPSTREAM_TIMEOUTS.get(host, DEFAULT_TIMEOUT)
+
+
+# Подмена апстримов: хост -> базовый URL (например, локальные заглушки в benchmarks/offline.py)
+upstream_overrides = {}
+
+
+def upstream_url(url):
+    if not upstream_overrides:
+        return url
+    parsed = yarl.URL(url)
+    base = upstream_overrides.get(parsed.host)
+    if base is None:
+        return url
+    base = yarl.URL(base)
+    return str(parsed.with_scheme(base.scheme).with_host(base.host).with_port(base.port))
+
+
+# Метрики процесса для /metrics в app.py (формат Prometheus). Запись - пара операций со словарем
+# и bisect по границам корзин, кэши и single-flight опрашиваются только при выгрузке.
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # сек
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя корзина - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}  # (имя, метки) -> Histogram
+        self.counters = {}  # (имя, метки) -> число
+        self.caches = {}  # имя -> TTLCache
+        self.flights = {}  # имя -> SingleFlight
+        self.collectors = []  # функции -> [(имя, тип, {метки}, значение)], читаются при каждом render()
+        self.descriptions = {}
+
+    def describe(self, name, text):
+        self.descriptions[name] = text
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(labels.items()))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def register_cache(self, name, cache):
+        self.caches[name] = cache
+
+    def register_flight(self, name, flight):
+        self.flights[name] = flight
+
+    def register_collector(self, collector):
+        self.collectors.append(collector)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels) + '}'
+
+    def _header(self, lines, name, kind, seen):
+        if name in seen:
+            return
+        seen.add(name)
+        lines.append(f'# HELP {name} {self.descriptions.get(name, name)}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    def render(self):
+        lines = []
+        seen = set()
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            self._header(lines, name, 'histogram', seen)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{self._labels(labels)} {histogram.sum:.6f}')
+            lines.append(f'{name}_count{self._labels(labels)} {histogram.count}')
+        for (name, labels), value in sorted(self.counters.items(), key=lambda item: item[0]):
+            self._header(lines, name, 'counter', seen)
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        cache_metrics = (
+            ('cache_hits_total', 'counter', 'hits'),
+            ('cache_misses_total', 'counter', 'misses'),
+            ('cache_entries', 'gauge', 'entries'),
+            ('cache_bytes', 'gauge', 'bytes'),
+        )
+        stats = {name: cache.stats() for name, cache in self.caches.items()}
+        for metric, kind, field in cache_metrics:
+            self._header(lines, metric, kind, seen)
+            for name in sorted(stats):
+                lines.append(f'{metric}{{cache="{name}"}} {stats[name][field]}')
+        self._header(lines, 'singleflight_shared_total', 'counter', seen)
+        for name in sorted(self.flights):
+            lines.append(f'singleflight_shared_total{{flight="{name}"}} {self.flights[name].shared}')
+        samples = []
+        for collector in self.collectors:
+            try:
+                samples.extend(collector())
+            except Exception as e:
+                print(f"[ERROR] Метрики: сборщик {getattr(collector, '__name__', collector)}: {e}")
+        samples.sort(key=lambda sample: sample[0])
+        for name, kind, labels, value in samples:
+            self._header(lines, name, kind, seen)
+            lines.append(f'{name}{self._labels(labels.items())} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('bot_handler_seconds', 'Время обработки сообщения по командам')
+metrics.describe('bot_handler_errors_total', 'Необработанные исключения в командах')
+metrics.describe('bot_flood_blocked_total', 'Сообщения, отклоненные антифлудом')
+metrics.describe('upstream_request_seconds', 'Время HTTP-запроса к апстриму по хостам')
+metrics.describe('upstream_requests_total', 'HTTP-запросы к апстримам по хостам и статусам')
+metrics.describe('fetch_json_failures_total', 'Запросы fetch_json, вернувшие None из-за ошибки')
+metrics.describe('vk_upload_seconds', 'Время загрузки вложения в VK')
+metrics.describe('callback_events_total', 'События Callback API по типам и результатам проверки')
+metrics.describe('dialogs_expired_total', 'Брошенные диалоги, выметенные по истечении срока')
+metrics.describe('cache_hits_total', 'Попадания в кэши бота')
+metrics.describe('cache_misses_total', 'Промахи кэшей бота')
+metrics.describe('cache_entries', 'Записей в кэше')
+metrics.describe('cache_bytes', 'Размер кэша, байт')
+metrics.describe('singleflight_shared_total', 'Вызовы, дождавшиеся уже идущего запроса с тем же ключом')
+metrics.describe('flood_checks_total', 'Проверки антифлуда по результату')
+metrics.describe('flood_check_seconds', 'Время проверки антифлуда (чтение и запись ведра в state_backend)')
+metrics.describe('flood_check_errors_total', 'Проверки антифлуда, пропущенные из-за недоступного state_backend')
+
+
+def record_upstream(url, status, started):
+    host = yarl.URL(url).host
+    metrics.observe('upstream_request_seconds', time.perf_counter() - started, host=host)
+    metrics.inc('upstream_requests_total', host=host, status=status)
+    record_span('fetch', started, host=host, status=status)
+
+
+# Трассировка: на каждое событие VK открывается корневой спан, внутри - спаны скачиваний, разбора,
+# обработки картинок, загрузок и вызовов VK API. Текущий спан живет в contextvars, поэтому задачи,
+# созданные внутри обработчика (в том числе single-flight), пишут в тот же трейс.
+# Вне трейса (фоновые задачи) спаны не создаются.
+TRACE_BUFFER_SIZE = 200  # последних трейсов для /traces
+TRACE_SLOW_THRESHOLD = 2.0  # трейсы дольше этого печатаются целиком, сек
+TRACES_TOKEN = os.getenv('TRACES_TOKEN')  # без него /traces отключен
+
+
+class Span:
+    __slots__ = ('name', 'attrs', 'started', 'duration', 'children')
+
+    def __init__(self, name, attrs, started=None):
+        self.name = name
+        self.attrs = attrs
+        self.started = started if started is not None else time.perf_counter()
+        self.duration = None
+        self.children = []
+
+    def finish(self, finished=None):
+        self.duration = (finished if finished is not None else time.perf_counter()) - self.started
+
+    def to_dict(self, origin):
+        return {
+            'name': self.name,
+            'start_ms': round((self.started - origin) * 1000, 2),
+            'duration_ms': round(self.duration * 1000, 2) if self.duration is not None else None,
+            'attrs': self.attrs,
+            'children': [child.to_dict(origin) for child in self.children],
+        }
+
+    def breakdown(self, origin, depth=0):
+        attrs = ' '.join(f"{key}={value}" for key, value in self.attrs.items())
+        duration = f"{self.duration * 1000:.0f} мс" if self.duration is not None else "не завершен"
+        lines = [f"{'  ' * depth}{self.name} +{(self.started - origin) * 1000:.0f} мс {duration} {attrs}".rstrip()]
+        for child in self.children:
+            lines.extend(child.breakdown(origin, depth + 1))
+        return lines
+
+
+current_span = contextvars.ContextVar('current_span', default=None)
+trace_ids = itertools.count(1)
+recent_traces = deque(maxlen=TRACE_BUFFER_SIZE)  # (id, unix time, корневой спан)
+
+
+@contextlib.contextmanager
+def trace_span(name, **attrs):
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    span = Span(name, attrs)
+    parent.children.append(span)
+    token = current_span.set(span)
+    try:
+        yield span
+    finally:
+        span.finish()
+        current_span.reset(token)
+
+
+def record_span(name, started, **attrs):
+    # Уже завершившийся участок (время начала известно): добавить в текущий трейс
+    parent = current_span.get()
+    if parent is not None:
+        span = Span(name, attrs, started)
+        span.finish()
+        parent.children.append(span)
+
+
+def tag_trace(**attrs):
+    span = current_span.get()
+    if span is not None:
+        span.attrs.update(attrs)
+
+
+@contextlib.contextmanager
+def start_trace(name, **attrs):
+    root = Span(name, attrs)
+    token = current_span.set(root)
+    try:
+        yield root
+    finally:
+        root.finish()
+        current_span.reset(token)
+        trace_id = next(trace_ids)
+        recent_traces.append((trace_id, time.time(), root))
+        if root.duration > TRACE_SLOW_THRESHOLD:
+            print(f"[SLOW] Трейс {trace_id}:\n" + '\n'.join(root.breakdown(root.started)))
+
+
+def export_traces(limit=50, min_duration=0.0):
+    result = []
+    for trace_id, wall_time, root in reversed(recent_traces):
+        if root.duration is None or root.duration < min_duration:
+            continue
+        trace = root.to_dict(root.started)
+        trace['trace_id'] = trace_id
+        trace['time'] = datetime.fromtimestamp(wall_time).isoformat(timespec='milliseconds')
+        result.append(trace)
+        if len(result) >= limit:
+            break
+    return result
+
+
+def event_trace_attrs(event):
+    # Что показать в корне трейса: тип события, чат и длину текста или payload, но не сами сообщения
+    attrs = {'type': event.get('type')}
+    obj = event.get('object') or {}
+    message = obj.get('message') if isinstance(obj.get('message'), dict) else obj
+    for field in ('peer_id', 'from_id', 'user_id'):
+        if field in message:
+            attrs[field] = message[field]
+    if message.get('text'):
+        attrs['text_length'] = len(message['text'])
+    if message.get('payload'):
+        attrs['payload_length'] = len(str(message['payload']))
+    return attrs
+
+
+def report_handler_error(command, error):
+    metrics.inc('bot_handler_errors_total', command=command)
+    tag_trace(error=type(error).__name__)
+
+
+# Время и ошибки обработчика (команды, ввода в диалоге, callback-кнопки) в метриках и в трейсе события
+@contextlib.contextmanager
+def handler_metrics(command):
+    tag_trace(command=command)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        report_handler_error(command, e)
+        raise
+    finally:
+        metrics.observe('bot_handler_seconds', time.perf_counter() - started, command=command)
+
+
+# То же для обработчиков raw_event (нажатия callback-кнопок)
+def instrumented(handler):
+    async def wrapper(event):
+        with handler_metrics(handler.__name__):
+            return await handler(event)
+    wrapper.__name__ = handler.__name__
+    return wrapper
+
+
+# Объединение одинаковых одновременных запросов: все ждут один общий запрос к апстриму
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self.shared = 0  # сколько вызовов получили результат чужого запроса
+
+    async def do(self, key, func):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self.shared += 1
+        # shield: отмена одного ожидающего не должна отменять запрос для остальных
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # чтобы asyncio не ругался на необработанное исключение
+
+    def __len__(self):
+        return len(self._calls)
+
+
+upstream_flight = SingleFlight()
+metrics.register_flight('upstream', upstream_flight)
+
+
+def request_key(url, params):
+    return url, tuple(sorted((params or {}).items()))
+
+
+async def _fetch_bytes(url, params=None):
+    session = await get_http_session()
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        async with session.get(upstream_url(url), params=params, timeout=get_timeout(url)) as response:
+            status = response.status
+            response.raise_for_status()
+            return await response.read()
+    finally:
+        record_upstream(url, status, started)
+
+
+# Скачивание файла целиком; при ошибке HTTP бросает aiohttp.ClientResponseError
+async def fetch_bytes(url, params=None):
+    return await upstream_flight.do(('bytes',) + request_key(url, params), lambda: _fetch_bytes(url, params))
+
+
+async def _fetch_text(url, params=None):
+    session = await get_http_session()
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        async with session.get(upstream_url(url), params=params, timeout=get_timeout(url)) as response:
+            status = response.status
+            response.raise_for_status()
+            return await response.text()
+    finally:
+        record_upstream(url, status, started)
+
+
+async def fetch_text(url, params=None):
+    return await upstream_flight.do(('text',) + request_key(url, params), lambda: _fetch_text(url, params))
+
+
+# Условный GET: возвращает (None, etag, last_modified), если файл не изменился (304)
+async def fetch_conditional(url, etag=None, last_modified=None):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    session = await get_http_session()
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        async with session.get(upstream_url(url), headers=headers, timeout=get_timeout(url)) as response:
+            status = response.status
+            if response.status == 304:
+                return None, etag, last_modified
+            response.raise_for_status()
+            data = await response.read()
+            return data, response.headers.get('ETag'), response.headers.get('Last-Modified')
+    finally:
+        record_upstream(url, status, started)
+
+
+# Кэш ответов с временем жизни и вытеснением давно не использованных записей (LRU)
+class TTLCache:
+    def __init__(self, max_entries=1000, max_bytes=10 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, size, value)
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, size, value = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl, size=0):
+        if size > self.max_bytes:
+            return
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (time.monotonic() + ttl, size, value)
+        self.total_bytes += size
+        while len(self._data) > self.max_entries or self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self._data)))
+
+    def _remove(self, key):
+        _, size, _ = self._data.pop(key)
+        self.total_bytes -= size
+
+    def ttl(self, key):
+        # Сколько еще проживет запись, сек (None, если ее нет); счетчики попаданий не трогает
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        return max(0.0, entry[0] - time.monotonic())
+
+    def clear(self):
+        self._data.clear()
+        self.total_bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'entries': len(self._data),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+# Время жизни ответов WeatherAPI по эндпоинтам, сек
+WEATHER_CACHE_TTL = {
+    'current.json': 600,  # WeatherAPI обновляет текущую погоду раз в 10-15 минут
+    'forecast.json': 600,  # сводка по городу (get_weather_snapshot) содержит и текущую погоду
+    'astronomy.json': 6 * 3600,
+    'search.json': 24 * 3600,
+}
+weather_cache = TTLCache(max_entries=2000, max_bytes=20 * 1024 * 1024)
+metrics.register_cache('weather', weather_cache)
+
+
+def weather_cache_key(url, params):
+    endpoint = url.rsplit('/', 1)[-1]
+    if not url.startswith(weather_url) or endpoint not in WEATHER_CACHE_TTL:
+        return None
+    query = []
+    for name, value in (params or {}).items():
+        if name == 'key':
+            continue
+        value = str(value).strip()
+        if name == 'q':
+            value = ' '.join(value.lower().replace('ё', 'е').split())
+        query.append((name, value))
+    return endpoint, tuple(sorted(query))
+
+
+async def _fetch_json(url, params, cache_key):
+    body = await _fetch_bytes(url, params)
+    data = json.loads(body)
+    if cache_key is not None and data:
+        weather_cache.set(cache_key, data, WEATHER_CACHE_TTL[cache_key[0]], size=len(body))
+    return data
+
+
 # Асинхронная замена requests.get()
 async def fetch_json(url, params=None):
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url, params=params) as response:
-                response.raise_for_status()
-                return await response.json()
-        except Exception as e:
-            print(f"Request error: {e}")
+    cache_key = weather_cache_key(url, params)
+    if cache_key is not None:
+        cached = weather_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    flight_key = ('json',) + (cache_key if cache_key is not None else request_key(url, params))
+    try:
+        return await upstream_flight.do(flight_key, lambda: _fetch_json(url, params, cache_key))
+    except Exception as e:
+        print(f"Request error: {e}")
+        metrics.inc('fetch_json_failures_total', host=yarl.URL(url).host)
+        return None
+
+
+# Повторное использование загруженных в VK фотографий: одна и та же картинка (карта, метеограмма)
+# загружается один раз и дальше отправляется всем чатам по строке вложения photo{owner}_{id}
+PHOTO_ATTACHMENT_TTL = 24 * 3600  # сек
+photo_attachments = TTLCache(max_entries=1000)  # sha256 содержимого -> строка вложения
+photo_upload_flight = SingleFlight()
+metrics.register_cache('photo_attachments', photo_attachments)
+metrics.register_flight('photo_upload', photo_upload_flight)
+
+
+async def _upload_photo(digest, image_data, peer_id):
+    uploader = PhotoMessageUploader(bot.api)
+    params = {'peer_id': peer_id} if peer_id else {}
+    started = time.perf_counter()
+    with trace_span('upload', kind='photo', size=len(image_data)):
+        attachment = await uploader.upload(file_source=BytesIO(image_data), **params)
+    metrics.observe('vk_upload_seconds', time.perf_counter() - started, kind='photo')
+    photo_attachments.set(digest, attachment, PHOTO_ATTACHMENT_TTL)
+    return attachment
+
+
+async def upload_photo(image_data, peer_id=None):
+    digest = hashlib.sha256(image_data).hexdigest()
+    attachment = photo_attachments.get(digest)
+    if attachment is not None:
+        return attachment
+    # Одновременные загрузки одной картинки ждут одну общую
+    return await photo_upload_flight.do(digest, lambda: _upload_photo(digest, image_data, peer_id))
+
+
+# Сводка погоды по городу: один запрос forecast.json (текущая погода, прогноз, восход/закат,
+# качество воздуха и предупреждения) на все команды погоды. Разобранный ответ кэшируется в fetch_json.
+SNAPSHOT_DAYS = 3
+
+
+async def get_weather_snapshot(city):
+    parameters = {'key': api_key, 'q': city, 'days': SNAPSHOT_DAYS, 'aqi': 'yes', 'alerts': 'yes', 'lang': 'ru'}
+    return await fetch_json(f'{weather_url}/forecast.json', params=parameters)
+
+# Состояние пользователей (игра, антифлуд, обработанные события Callback API) хранится в бэкенде
+# по строковым ключам, значения - JSON. STATE_BACKEND: memory (по умолчанию, один процесс),
+# sqlite:///state.db (несколько воркеров на одной машине) или redis://[:пароль@]host:port/db
+# (любое хранилище с протоколом Redis). Время истечения ключей - по настенным часам, общим для процессов.
+STATE_SWEEP_INTERVAL = 300  # как часто чистить истекшие ключи в памяти и в SQLite, сек
+STATE_SQLITE_FILE = 'state.db'
+REDIS_POOL_SIZE = 8  # соединений с Redis на процесс
+STATE_BACKEND_TIMEOUT = 5  # ожидание блокировки SQLite и ответа Redis, сек
+
+
+class StateBackend(abc.ABC):
+    @abc.abstractmethod
+    async def get(self, key):
+        ...
+
+    # ttl в секундах, None - без срока
+    @abc.abstractmethod
+    async def set(self, key, value, ttl=None):
+        ...
+
+    # Записать, только если ключа нет (или он истек); True, если записали
+    @abc.abstractmethod
+    async def add(self, key, value, ttl=None):
+        ...
+
+    @abc.abstractmethod
+    async def delete(self, key):
+        ...
+
+    async def close(self):
+        pass
+
+
+class MemoryStateBackend(StateBackend):
+    # Значения хранятся сериализованными, чтобы вести себя как общие бэкенды (копия при каждом чтении)
+    def __init__(self, sweep_interval=STATE_SWEEP_INTERVAL):
+        self._data = {}  # key -> (expires_at или None, JSON)
+        self.sweep_interval = sweep_interval
+        self._next_sweep = time.time() + sweep_interval
+
+    def _alive(self, key, now):
+        entry = self._data.get(key)
+        if entry is None:
             return None
+        if entry[0] is not None and entry[0] <= now:
+            del self._data[key]
+            return None
+        return entry
 
-# Global variables for game state
-user_guess_temp_state = {}
-current_handlers = {}  # Для хранения текущих обработчиков
+    async def get(self, key):
+        entry = self._alive(key, time.time())
+        return json.loads(entry[1]) if entry is not None else None
 
-# Добавим функцию для безопасного удаления обработчиков
-def clear_user_handlers(user_id):
-    if user_id in current_handlers:
-        del current_handlers[user_id]
+    async def set(self, key, value, ttl=None):
+        now = time.time()
+        if now >= self._next_sweep:
+            self.sweep(now)
+        self._data[key] = (now + ttl if ttl is not None else None, json.dumps(value, ensure_ascii=False))
 
-# Добавляем ТОЛЬКО для временных обработчиков:
-async def handle_message(message: Message):
-    user_id = message.from_id
-    if user_id in current_handlers:
+    async def add(self, key, value, ttl=None):
+        if self._alive(key, time.time()) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete(self, key):
+        self._data.pop(key, None)
+
+    def sweep(self, now=None):
+        now = now if now is not None else time.time()
+        stale = [key for key, (expires_at, _) in self._data.items() if expires_at is not None and expires_at <= now]
+        for key in stale:
+            del self._data[key]
+        self._next_sweep = now + self.sweep_interval
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteStateBackend(StateBackend):
+    # Один поток на соединение; WAL позволяет нескольким процессам читать и писать один файл
+    def __init__(self, path, sweep_interval=STATE_SWEEP_INTERVAL):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self._next_sweep = time.time() + sweep_interval
+        self._db = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='state-sqlite')
+
+    def _connection(self):
+        if self._db is None:
+            self._db = sqlite3.connect(
+                self.path, timeout=STATE_BACKEND_TIMEOUT, isolation_level=None, check_same_thread=False
+            )
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)'
+            )
+        return self._db
+
+    def _get(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)', (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set(self, key, value, ttl):
+        now = time.time()
+        db = self._connection()
+        db.execute(
+            'INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, json.dumps(value, ensure_ascii=False), now + ttl if ttl is not None else None)
+        )
+        if now >= self._next_sweep:
+            db.execute('DELETE FROM state WHERE expires_at <= ?', (now,))
+            self._next_sweep = now + self.sweep_interval
+
+    def _add(self, key, value, ttl):
+        now = time.time()
+        cursor = self._connection().execute(
+            'INSERT INTO state (key, value, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at '
+            'WHERE state.expires_at IS NOT NULL AND state.expires_at <= ?',
+            (key, json.dumps(value, ensure_ascii=False), now + ttl if ttl is not None else None, now)
+        )
+        return cursor.rowcount == 1
+
+    def _delete(self, key):
+        self._connection().execute('DELETE FROM state WHERE key = ?', (key,))
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def get(self, key):
+        return await self._run(self._get, key)
+
+    async def set(self, key, value, ttl=None):
+        await self._run(self._set, key, value, ttl)
+
+    async def add(self, key, value, ttl=None):
+        return await self._run(self._add, key, value, ttl)
+
+    async def delete(self, key):
+        await self._run(self._delete, key)
+
+    async def close(self):
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+
+# Ответ Redis с ошибкой (-ERR ...): команда не выполнена, но ответ прочитан целиком и соединение исправно
+class RedisError(RuntimeError):
+    pass
+
+
+class RedisStateBackend(StateBackend):
+    # Минимальный клиент протокола RESP: GET, SET (PX, NX), DEL; небольшой пул соединений
+    def __init__(self, url, pool_size=REDIS_POOL_SIZE):
+        url = yarl.URL(url)
+        self.host = url.host or 'localhost'
+        self.port = url.port or 6379
+        self.password = url.password
+        self.db = int(url.path.strip('/') or 0)
+        self._slots = asyncio.Semaphore(pool_size)
+        self._idle = []  # (reader, writer)
+
+    async def _open(self):
+        connection = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), STATE_BACKEND_TIMEOUT)
         try:
-            handler = current_handlers[user_id]
-            await handler(message)
-            if getattr(handler, "once", False):
-                clear_user_handlers(user_id)
-        except Exception as e:
-            print(f"Ошибка: {e}")
-            clear_user_handlers(user_id)
-            await message.answer("Ошибка обработки")
+            if self.password:
+                await self._roundtrip(connection, ('AUTH', self.password))
+            if self.db:
+                await self._roundtrip(connection, ('SELECT', self.db))
+        except BaseException:
+            connection[1].close()
+            raise
+        return connection
+
+    @staticmethod
+    def _encode(args):
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(f'${len(data)}\r\n'.encode() + data + b'\r\n')
+        return b''.join(parts)
+
+    @classmethod
+    async def _read_reply(cls, reader):
+        line = await reader.readuntil(b'\r\n')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            # не бросаем сразу: внутри массива нужно дочитать остальные элементы
+            return RedisError(f"Redis: {payload.decode(errors='replace')}")
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            size = int(payload)
+            if size < 0:
+                return None
+            return (await reader.readexactly(size + 2))[:-2]
+        if kind == b'*':
+            size = int(payload)
+            if size < 0:
+                return None
+            return [await cls._read_reply(reader) for _ in range(size)]
+        raise RuntimeError(f"Redis: неожиданный ответ {line[:50]!r}")
+
+    async def _roundtrip(self, connection, args):
+        reader, writer = connection
+        writer.write(self._encode(args))
+        await writer.drain()
+        reply = await asyncio.wait_for(self._read_reply(reader), STATE_BACKEND_TIMEOUT)
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+    async def command(self, *args):
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else await self._open()
+            try:
+                reply = await self._roundtrip(connection, args)
+            except RedisError:
+                self._idle.append(connection)  # ошибка команды, соединение исправно
+                raise
+            except BaseException:
+                # обрыв, таймаут или непонятный ответ: что осталось в сокете, неизвестно
+                connection[1].close()
+                raise
+            self._idle.append(connection)
+            return reply
+
+    @staticmethod
+    def _expiry(ttl):
+        return ('PX', max(1, int(ttl * 1000))) if ttl is not None else ()
+
+    async def get(self, key):
+        data = await self.command('GET', key)
+        return json.loads(data) if data is not None else None
+
+    async def set(self, key, value, ttl=None):
+        await self.command('SET', key, json.dumps(value, ensure_ascii=False), *self._expiry(ttl))
+
+    async def add(self, key, value, ttl=None):
+        return await self.command('SET', key, json.dumps(value, ensure_ascii=False), 'NX', *self._expiry(ttl)) == 'OK'
+
+    async def delete(self, key):
+        await self.command('DEL', key)
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+        await asyncio.gather(*(writer.wait_closed() for _, writer in idle), return_exceptions=True)
+
+
+def make_state_backend(spec):
+    spec = (spec or 'memory').strip()
+    if spec == 'memory':
+        return MemoryStateBackend()
+    if spec == 'sqlite':
+        return SQLiteStateBackend(STATE_SQLITE_FILE)
+    if spec.startswith('sqlite:///'):
+        return SQLiteStateBackend(spec[len('sqlite:///'):])
+    if spec.startswith('redis://'):
+        return RedisStateBackend(spec)
+    raise ValueError("Error: STATE_BACKEND must be memory, sqlite:///<file> or redis://host:port/db")
+
+
+state_backend = make_state_backend(os.getenv('STATE_BACKEND'))
+
+# Диалоги (ввод города, аэропорта, региона и станции, игра и т.д.) - конечный автомат. Состояние
+# пользователя - запись [имя состояния, параметры, expires_at] в state_backend по ключу dialog:<user_id>,
+# обработчик состояния берется из dialog_states по имени. Запись переживает перезапуск и видна всем
+# воркерам; брошенный диалог истекает через ttl состояния: ключ удаляет сам бэкенд, а в этом процессе
+# его раньше выметает колесо таймеров (dialog_sweeper).
+DIALOG_TTL = 10 * 60  # сек
+DIALOG_WHEEL_RESOLUTION = 1  # шаг колеса таймеров, сек
+DIALOG_WHEEL_SLOTS = 512
+# Бэкенд хранит запись дольше срока диалога: истекшую удаляет и считает колесо, TTL бэкенда - запасной вариант,
+# если воркер, запустивший диалог, перезапустился
+DIALOG_EXPIRY_GRACE = 60  # сек
+
+
+class DialogState:
+    __slots__ = ('name', 'handler', 'ttl')
+
+    def __init__(self, name, handler, ttl):
+        self.name = name
+        self.handler = handler
+        self.ttl = ttl
+
+
+dialog_states = {}
+
+
+# Регистрирует обработчик состояния: async handler(message, **params)
+def dialog_state(name, ttl=DIALOG_TTL):
+    def register(handler):
+        dialog_states[name] = DialogState(name, handler, ttl)
+        return handler
+    return register
+
+
+# Хешированное колесо таймеров: ключ лежит в ячейке своего срока по модулю числа ячеек, каждый шаг
+# проверяет одну ячейку. Сроки дальше одного оборота остаются в ячейке до следующего прохода.
+class TimerWheel:
+    def __init__(self, resolution=DIALOG_WHEEL_RESOLUTION, slots=DIALOG_WHEEL_SLOTS, now=None):
+        self.resolution = resolution
+        self.slots = [{} for _ in range(slots)]  # key -> deadline
+        self.positions = {}  # key -> индекс ячейки
+        self.tick = int((now if now is not None else time.time()) // resolution)
+
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        tick = max(math.ceil(deadline / self.resolution), self.tick + 1)
+        index = tick % len(self.slots)
+        self.slots[index][key] = deadline
+        self.positions[key] = index
+
+    def cancel(self, key):
+        index = self.positions.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    # -> ключи, срок которых наступил к now
+    def advance(self, now):
+        due = []
+        target = int(now // self.resolution)
+        steps = min(target - self.tick, len(self.slots))
+        self.tick = target - steps
+        for _ in range(steps):
+            self.tick += 1
+            slot = self.slots[self.tick % len(self.slots)]
+            for key, deadline in list(slot.items()):
+                if deadline <= now:
+                    del slot[key]
+                    del self.positions[key]
+                    due.append(key)
+        return due
+
+    def __len__(self):
+        return len(self.positions)
+
+
+dialog_wheel = TimerWheel()
+
+
+def dialog_key(user_id):
+    return f'dialog:{user_id}'
+
+
+async def enter_dialog(user_id, name, **params):
+    state = dialog_states[name]
+    expires_at = time.time() + state.ttl
+    await state_backend.set(dialog_key(user_id), [name, params, expires_at], ttl=state.ttl + DIALOG_EXPIRY_GRACE)
+    dialog_wheel.schedule(user_id, expires_at)
+
+
+async def end_dialog(user_id):
+    dialog_wheel.cancel(user_id)
+    await state_backend.delete(dialog_key(user_id))
+
 
-# Регистрируем его ТОЛЬКО для сообщений с payload:
+# -> (DialogState, параметры) или (None, None)
+async def get_dialog(user_id):
+    record = await state_backend.get(dialog_key(user_id))
+    if record is None:
+        return None, None
+    name, params, expires_at = record
+    state = dialog_states.get(name)
+    if state is None or expires_at <= time.time():
+        return None, None  # истекло или состояние из другой версии бота
+    return state, params
+
+
+async def handle_dialog(message: Message, state, params):
+    try:
+        await state.handler(message, **params)
+    except Exception as e:
+        # Пользователю отвечаем сами, но ошибка должна попасть в метрики и трейс, как у команд
+        report_handler_error(state.name, e)
+        print(f"[ERROR] Ошибка в диалоге {state.name}: {e}")
+        await end_dialog(message.from_id)
+        await message.answer("⚠️ Произошла ошибка.")
+
+
+async def dialog_sweeper():
+    while True:
+        await asyncio.sleep(dialog_wheel.resolution)
+        now = time.time()
+        for user_id in dialog_wheel.advance(now):
+            try:
+                record = await state_backend.get(dialog_key(user_id))
+                # Другой воркер мог продлить диалог: удаляем, только если запись и правда истекла.
+                # Записи уже нет, если диалог завершил другой воркер или бэкенд выбросил ее по своему TTL:
+                # такие не считаем
+                if record is not None and record[2] > now:
+                    dialog_wheel.schedule(user_id, record[2])  # ждем новый срок
+                    continue
+                if record is not None:
+                    await state_backend.delete(dialog_key(user_id))
+                    metrics.inc('dialogs_expired_total')
+            except Exception as e:
+                print(f"[ERROR] Не удалось удалить истекший диалог {user_id}: {e}")
+
+
+# Регистрируем его ТОЛЬКО для сообщений с payload: кнопка во время диалога - ввод для диалога.
+# Идет через тот же антифлуд и метрики, что и обычные сообщения
 @bot.on.message(payload_map={"cmd": str})
 async def payload_handler(message: Message):
-    await handle_message(message)
-
-# Обработчик временных состояний (ввод города и т.д.)
-async def handle_temporary_state(event: typing.Union[Message, MessageEvent]):
     try:
-        # Получаем user_id в зависимости от типа события
-        user_id = event.from_id if isinstance(event, Message) else event.user_id
-        peer_id = event.peer_id if isinstance(event, Message) else event.peer_id
-        
-        if user_id in current_handlers:
-            handler = current_handlers[user_id]
-            await handler(event)
-            if getattr(handler, "once", False):
-                clear_user_handlers(user_id)
-            return True
-        return False
+        state, params = await get_dialog(message.from_id)
     except Exception as e:
-        print(f"[ERROR] Ошибка в handle_temporary_state: {e}")
-        clear_user_handlers(user_id)
-        await bot.api.messages.send(peer_id=peer_id, message="⚠️ Произошла ошибка.", random_id=0)
-        return True
-    
+        print(f"[ERROR] Хранилище состояний недоступно, диалог пропущен: {e}")
+        return
+    if state is not None:
+        await dispatch_message(message, state.name, lambda: handle_dialog(message, state, params))
+
 # File names
 CITIES_FILE = 'cities.csv'
 USER_STATS_FILE = 'user_statistics.csv'
 
 # Flood control settings
-FLOOD_LIMIT = 10
-FLOOD_INTERVAL = 60
-BLOCK_TIME = 60
+FLOOD_LIMIT = 10  # емкость ведра, маркеров
+FLOOD_INTERVAL = 60  # за это время пустое ведро наполняется целиком, сек
+
+# Стоимость команд в маркерах по классам; ключи COMMAND_CLASSES - имена обработчиков команд
+# и имена состояний диалогов
+COMMAND_CLASS_COSTS = {
+    'light': 1,  # справка, меню, ссылки
+    'weather': 2,  # запрос к WeatherAPI
+    'map': 3,  # скачивание и загрузка картинки или разбор страницы meteoinfo
+    'meteogram': 5,  # метеограммы ГМЦ, до 10 картинок за раз
+}
+COMMAND_CLASSES = {
+    'now_weather_handler': 'weather',
+    'forecast_weather_handler': 'weather',
+    'aqi_handler': 'weather',
+    'alerts_handler': 'weather',
+    'location': 'weather',
+    'airport': 'weather',
+    'precipitation_map_handler': 'map',
+    'anomaly_temp_map_handler': 'map',
+    'temp_water_map_handler': 'map',
+    'vertical_temp_handler': 'map',
+    'fire_hazard_map_handler': 'map',
+    'extrainfo_handler': 'map',
+    'stations_station': 'map',
+    'meteo_one_city': 'meteogram',
+    'meteo_several_cities': 'meteogram',
+    # callback-кнопки: график рисуется сразу, а кнопки метеограмм только открывают диалог,
+    # метеограммы тарифицируются при вводе городов
+    'handle_station_chart': 'map',
+    'handle_meteo_one_city': 'light',
+    'handle_meteo_several_cities': 'light',
+}
+
+
+def command_cost(command):
+    return COMMAND_CLASS_COSTS[COMMAND_CLASSES.get(command, 'light')]
 
 # Helper functions
 def convert_to_mps(kph):
@@ -153,107 +1187,389 @@ def get_wind_direction(deg):
     return directions.get(deg, 'Неизвестное направление')
 
 
-user_requests = {}  # { "peer_user": { ... } }
+# Маркерное ведро: маркеры копятся со скоростью FLOOD_LIMIT / FLOOD_INTERVAL в секунду до FLOOD_LIMIT,
+# каждая команда списывает свою стоимость. Ведро [маркеры, время] лежит в state_backend и живет, пока
+# не наполнится снова: после этого оно ничем не отличается от нового.
+# Чтение и запись не атомарны: одновременные сообщения одного пользователя в разные воркеры
+# могут списать маркеры дважды из одного остатка, что для антифлуда допустимо.
+class RateLimiter:
+    def __init__(self, backend, capacity=FLOOD_LIMIT, interval=FLOOD_INTERVAL):
+        self.backend = backend
+        self.capacity = capacity
+        self.rate = capacity / interval
+
+    # Возвращает 0, если запрос разрешен, иначе сколько секунд ждать
+    async def acquire(self, key, cost=1):
+        now = time.time()
+        cost = min(cost, self.capacity)
+        bucket = await self.backend.get(f'flood:{key}')
+        if bucket is None:
+            tokens = self.capacity
+        else:
+            tokens, updated = bucket
+            tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / self.rate
+        refill = (self.capacity - tokens) / self.rate
+        await self.backend.set(f'flood:{key}', [tokens, now], ttl=max(refill, 1))
+        return wait
+
+
+rate_limiter = RateLimiter(state_backend)
+
+# Data storage functions
+# Города пользователей - в state_backend по ключу city:<user_id> без срока: с общим бэкендом (SQLite, Redis)
+# город, заданный через один воркер, видят все. CITIES_FILE - прежнее хранилище, при старте его строки
+# один раз переносятся в бэкенд (последняя строка для user_id побеждает, уже заданные города не трогаем)
+CITIES_FILE_HEADER = ['user_id', 'city']
+
+
+def city_key(user_id):
+    return f'city:{user_id}'
+
+
+async def save_city(user_id, city_name):
+    await state_backend.set(city_key(user_id), city_name.strip())
 
-def is_flooding(user_id, peer_id=None):
-    current_time = time.time()
-    identifier = f"{peer_id}_{user_id}" if peer_id else str(user_id)
 
-    if identifier not in user_requests:
-        user_requests[identifier] = {
-            'last_request_time': current_time,
-            'request_count': 1,
-            'is_blocked': False,
-            'block_until': 0
+async def load_city(user_id):
+    return await state_backend.get(city_key(user_id))
+
+
+def read_cities_file(path):
+    cities = {}
+    if not os.path.exists(path):
+        return cities
+    with open(path, mode='r', encoding='utf-8', newline='') as file:
+        for row in csv.reader(file):
+            if len(row) == 2 and row != CITIES_FILE_HEADER:
+                cities[row[0]] = row[1]
+    return cities
+
+
+async def import_cities_file(path=CITIES_FILE):
+    marker = f'cities_imported:{path}'
+    if await state_backend.get(marker) is not None:
+        return
+    cities = await asyncio.to_thread(read_cities_file, path)
+    for user_id, city in cities.items():
+        await state_backend.add(city_key(user_id), city)
+    await state_backend.set(marker, len(cities))
+    if cities:
+        print(f"Города пользователей перенесены из {path}: {len(cities)}")
+
+# Статистика для /stats считается по журналу и периодически сохраняется в STATS_ROLLUP_FILE вместе со смещением
+# в журнале, так что после перезапуска дочитывается только хвост файла. В журнал пишут все воркеры, и каждый
+# дочитывает его хвост целиком, а не только свои строки: сводка любого воркера - состояние одного и того же
+# файла на каком-то смещении, поэтому неважно, чья перезапись STATS_ROLLUP_FILE окажется последней
+STATS_ROLLUP_FILE = 'user_statistics_rollup.json'
+ACTIVITY_LOG_HEADER = ['User ID', 'Username', 'Action', 'Timestamp']
+STATS_RECENT_SIZE = 50
+STATS_DAYS_KEPT = 30
+STATS_SAVE_INTERVAL = 300  # сек
+
+
+class ActivityStats:
+    def __init__(self, log_path, rollup_path):
+        self.log_path = log_path
+        self.rollup_path = rollup_path
+        self._reset()
+        self.last_saved = time.monotonic()
+        self._catching_up = asyncio.Lock()
+        self._load()
+
+    def _reset(self):
+        self.offset = 0  # сколько байт журнала уже учтено
+        self.total = 0
+        self.unique_users = set()
+        self.commands = Counter()
+        self.daily_users = {}  # 'YYYY-MM-DD' -> set(user_id)
+        self.recent = deque(maxlen=STATS_RECENT_SIZE)
+
+    def add(self, row):
+        if len(row) < 3 or row == ACTIVITY_LOG_HEADER:
+            return
+        self.total += 1
+        self.unique_users.add(row[0])
+        self.commands[row[2]] += 1
+        if len(row) >= 4:
+            day = row[3][:10]
+            if day not in self.daily_users:
+                self.daily_users[day] = set()
+                for old_day in sorted(self.daily_users)[:-STATS_DAYS_KEPT]:
+                    del self.daily_users[old_day]
+            self.daily_users[day].add(row[0])
+        self.recent.append(row)
+
+    def _load(self):
+        try:
+            if os.path.exists(self.rollup_path):
+                with open(self.rollup_path, mode='r', encoding='utf-8') as file:
+                    data = json.load(file)
+                self.offset = data['offset']
+                self.total = data['total']
+                self.unique_users = set(data['unique_users'])
+                self.commands = Counter(data['commands'])
+                self.daily_users = {day: set(users) for day, users in data['daily_users'].items()}
+                self.recent.extend(data['recent'])
+        except Exception as e:
+            print(f"Ошибка чтения сводки статистики, пересчитываем: {e}")
+            self._reset()
+        if os.path.exists(self.log_path) and os.path.getsize(self.log_path) < self.offset:
+            self._reset()  # журнал был заменен
+        self.apply(*self._read_tail(self.offset))
+
+    def _read_tail(self, offset):
+        # -> (строки, новое смещение); недописанную другим воркером последнюю строку оставляем на потом
+        if not os.path.exists(self.log_path):
+            return [], offset
+        with open(self.log_path, mode='rb') as file:
+            file.seek(offset)
+            tail = file.read()
+        tail = tail[:tail.rfind(b'\n') + 1]
+        return list(csv.reader(StringIO(tail.decode('utf-8')))), offset + len(tail)
+
+    def apply(self, rows, offset):
+        for row in rows:
+            self.add(row)
+        self.offset = offset
+
+    async def catch_up(self):
+        async with self._catching_up:
+            self.apply(*await asyncio.to_thread(self._read_tail, self.offset))
+
+    def to_dict(self):
+        return {
+            'offset': self.offset,
+            'total': self.total,
+            'unique_users': list(self.unique_users),
+            'commands': dict(self.commands),
+            'daily_users': {day: list(users) for day, users in self.daily_users.items()},
+            'recent': list(self.recent),
         }
-        return False
-
-    user_data = user_requests[identifier]
-
-    # Проверка на блокировку
-    if user_data['is_blocked']:
-        if current_time >= user_data['block_until']:
-            # Разблокируем
-            user_data.update({
-                'request_count': 1,
-                'last_request_time': current_time,
-                'is_blocked': False,
-                'block_until': 0
-            })
+
+    def save_due(self):
+        return time.monotonic() - self.last_saved >= STATS_SAVE_INTERVAL
+
+    def save(self, data):
+        tmp_path = self.rollup_path + '.tmp'
+        try:
+            with open(tmp_path, mode='w', encoding='utf-8') as file:
+                json.dump(data, file, ensure_ascii=False)
+            os.replace(tmp_path, self.rollup_path)
+        except Exception as e:
+            print(f"Ошибка сохранения сводки статистики: {e}")
+
+    async def persist(self):
+        self.last_saved = time.monotonic()
+        await asyncio.to_thread(self.save, self.to_dict())
+
+
+activity_stats = ActivityStats(USER_STATS_FILE, STATS_ROLLUP_FILE)
+
+
+# Журнал активности пользователей: каждая пара (user_id, action) пишется один раз на все воркеры - повторы
+# отсекает state_backend.add по ключу activity:<user_id>:<action>, как event_id в Callback API. В памяти
+# держим только пары, уже записанные в журнал (из файла при старте и после успешной записи пачки).
+# События складываем в очередь, фоновая задача дописывает их в USER_STATS_FILE пачками
+ACTIVITY_QUEUE_SIZE = 10000
+ACTIVITY_BATCH_SIZE = 200
+ACTIVITY_FLUSH_INTERVAL = 5  # сек
+ACTIVITY_CLAIM_TTL = 10 * 60  # отметка до записи: если воркер упал, не записав строку, она снимется сама, сек
+
+
+class ActivityLogger:
+    HEADER = ACTIVITY_LOG_HEADER
+
+    def __init__(self, path, stats, queue_size=ACTIVITY_QUEUE_SIZE, batch_size=ACTIVITY_BATCH_SIZE,
+                 flush_interval=ACTIVITY_FLUSH_INTERVAL):
+        self.path = path
+        self.stats_rollup = stats
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.seen = set()  # записанные пары
+        self.pending = set()  # пары в очереди или в записи
+        self.written = 0
+        self.dropped = 0
+        self._task = None
+        self._flushing = None
+        self._in_hand = []  # строки, взятые из очереди, но еще не записанные (при остановке)
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, mode='r', encoding='utf-8') as file:
+            reader = csv.reader(file)
+            next(reader, None)  # Пропускаем заголовок
+            for row in reader:
+                if len(row) >= 3:
+                    self.seen.add((row[0], row[2]))
+
+    def log(self, user_id, username, action):
+        key = (str(user_id), action.strip())
+        if key in self.seen or key in self.pending:
+            return  # Действие уже залогировано
+        row = [key[0], username, key[1], datetime.now().strftime("%Y-%m-%d %H:%M:%S")]
+        try:
+            self.queue.put_nowait(row)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return
+        self.pending.add(key)
+        if self._task is None:
+            self.start()
+
+    @staticmethod
+    def backend_key(key):
+        return f'activity:{key[0]}:{key[1]}'
+
+    async def _claim(self, batch):
+        # -> строки, которые еще никто не записал; если бэкенд недоступен, лучше повтор, чем потеря
+        claims = await asyncio.gather(
+            *(state_backend.add(self.backend_key((row[0], row[2])), 1, ACTIVITY_CLAIM_TTL) for row in batch),
+            return_exceptions=True
+        )
+        rows = []
+        for row, claim in zip(batch, claims):
+            if isinstance(claim, Exception):
+                print(f"[ERROR] Хранилище состояний недоступно, строка журнала без проверки повтора: {claim}")
+            if claim is False:
+                self.seen.add((row[0], row[2]))  # записал другой воркер
+            else:
+                rows.append(row)
+        return rows
+
+    async def _confirm(self, rows):
+        # Строки в журнале: отметки больше не истекают
+        results = await asyncio.gather(
+            *(state_backend.set(self.backend_key((row[0], row[2])), 1) for row in rows), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"[ERROR] Не удалось сохранить отметку журнала: {result}")
+                break
+
+    async def _release(self, rows):
+        # Запись не удалась: снимаем отметки, чтобы следующее такое же действие записалось заново
+        for row in rows:
+            try:
+                await state_backend.delete(self.backend_key((row[0], row[2])))
+            except Exception as e:
+                print(f"[ERROR] Не удалось снять отметку журнала {row[0]}/{row[2]}: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        batch = []
+        try:
+            while True:
+                batch.append(await self.queue.get())
+                if self.queue.qsize() < self.batch_size:
+                    await asyncio.sleep(self.flush_interval)
+                while len(batch) < self.batch_size and not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                # Запись не прерывается отменой: иначе строки потерялись бы или записались дважды
+                self._flushing = asyncio.ensure_future(self._flush(batch))
+                batch = []
+                await asyncio.shield(self._flushing)
+                if self.stats_rollup.save_due():
+                    await self.stats_rollup.persist()
+        finally:
+            # Отмена во время ожидания: взятые строки допишет stop()
+            self._in_hand = batch
+
+    async def _flush(self, batch):
+        try:
+            rows = await self._claim(batch)
+            if rows and await asyncio.to_thread(self._write, rows):
+                self.seen.update((row[0], row[2]) for row in rows)
+                await self._confirm(rows)
+            elif rows:
+                await self._release(rows)
+        finally:
+            self.pending.difference_update((row[0], row[2]) for row in batch)
+        # Сводка дочитывает журнал в цикле событий, а не в потоке записи: со строками других воркеров
+        await self.stats_rollup.catch_up()
+
+    def _write(self, batch):
+        # Пачка уходит в файл одной записью в режиме дозаписи: строки разных воркеров не перемешиваются
+        text = StringIO()
+        writer = csv.writer(text)
+        writer.writerows(batch)
+        try:
+            with open(self.path, mode='ab') as file:
+                if file.tell() == 0:  # Если файл пустой
+                    header = StringIO()
+                    csv.writer(header).writerow(self.HEADER)
+                    file.write(header.getvalue().encode('utf-8'))
+                file.write(text.getvalue().encode('utf-8'))
+            self.written += len(batch)
+            return True
+        except Exception as e:
+            self.dropped += len(batch)
+            print(f"Ошибка при логировании: {e}")
             return False
-        return True
 
-    # Сброс счётчика если прошло больше FLOOD_INTERVAL
-    if current_time - user_data['last_request_time'] > FLOOD_INTERVAL:
-        user_data['request_count'] = 1
-        user_data['last_request_time'] = current_time
-        return False
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._flushing is not None:
+            await self._flushing
+            self._flushing = None
+        # Дописываем взятое, но не записанное, и то, что осталось в очереди
+        batch, self._in_hand = self._in_hand, []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if batch:
+            await self._flush(batch)
+        else:
+            await self.stats_rollup.catch_up()
+        await self.stats_rollup.persist()
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'unique_actions': len(self.seen),
+        }
 
-    # Увеличиваем счётчик
-    user_data['request_count'] += 1
-    user_data['last_request_time'] = current_time
 
-    # Проверяем лимит
-    if user_data['request_count'] > FLOOD_LIMIT:
-        user_data['is_blocked'] = True
-        user_data['block_until'] = current_time + BLOCK_TIME
-        return True
+activity_logger = ActivityLogger(USER_STATS_FILE, activity_stats)
 
-    return False
 
-# Data storage functions
-def save_city(user_id, city_name):
-    user_id = str(user_id)
-    city_name = city_name.strip()
-    if not os.path.exists(CITIES_FILE):
-        with open(CITIES_FILE, mode='w', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerow(['user_id', 'city'])
-    data = {}
-    with open(CITIES_FILE, mode='r', encoding='utf-8') as file:
-        reader = csv.reader(file)
-        for row in reader:
-            if len(row) == 2:
-                data[row[0]] = row[1]
-    data[user_id] = city_name
-    with open(CITIES_FILE, mode='w', encoding='utf-8') as file:
-        writer = csv.writer(file)
-        writer.writerow(['user_id', 'city'])
-        for uid, city in data.items():
-            writer.writerow([uid, city])
-
-def load_city(user_id):
-    user_id = str(user_id)
-    if not os.path.exists(CITIES_FILE):
-        return None
-    with open(CITIES_FILE, mode='r', encoding='utf-8') as file:
-        reader = csv.reader(file)
-        for row in reader:
-            if len(row) == 2 and row[0] == user_id:
-                return row[1]
-    return None
+def activity_logger_metrics():
+    stats = activity_logger.stats()
+    return [
+        ('activity_log_queue_depth', 'gauge', {}, stats['queue_depth']),
+        ('activity_log_written_total', 'counter', {}, stats['written']),
+        ('activity_log_dropped_total', 'counter', {}, stats['dropped']),
+        ('activity_log_unique_actions', 'gauge', {}, stats['unique_actions']),
+    ]
+
+
+metrics.register_collector(activity_logger_metrics)
+metrics.describe('activity_log_queue_depth', 'Строк журнала активности в очереди на запись')
+metrics.describe('activity_log_written_total', 'Строк, записанных в журнал активности')
+metrics.describe('activity_log_dropped_total', 'Строк журнала активности, потерянных из-за переполнения очереди или ошибки записи')
+metrics.describe('activity_log_unique_actions', 'Уникальных пар (пользователь, действие) в журнале')
+
 
 def log_user_activity(user_id, username, action):
     try:
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        user_id = str(user_id)
-        action = action.strip()
-        
-        # Проверяем, не логировали ли мы уже это действие
-        if os.path.exists(USER_STATS_FILE):
-            with open(USER_STATS_FILE, mode='r', encoding='utf-8') as file:
-                reader = csv.reader(file)
-                next(reader, None)  # Пропускаем заголовок
-                for row in reader:
-                    if len(row) >= 3 and row[0] == user_id and row[2] == action:
-                        return  # Действие уже залогировано
-        
-        # Записываем новую запись
-        with open(USER_STATS_FILE, mode='a', encoding='utf-8', newline='') as file:
-            writer = csv.writer(file)
-            if file.tell() == 0:  # Если файл пустой
-                writer.writerow(['User ID', 'Username', 'Action', 'Timestamp'])
-            writer.writerow([user_id, username, action, current_time])
+        activity_logger.log(user_id, username, action)
     except Exception as e:
         print(f"Ошибка при логировании: {e}")
 
@@ -268,6 +1584,112 @@ def load_city_data(file_path):
 
 city_data = load_city_data('city_data.csv')
 
+
+# Нормализация названий: регистр, ё/е, дефисы, подчеркивания, скобки и лишние пробелы
+def normalize_name(text):
+    text = text.lower().replace('ё', 'е')
+    return ' '.join(re.sub(r'[\W_]+', ' ', text).split())
+
+
+def trigrams(name):
+    padded = f'  {name} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# Индекс названий: точный поиск по нормализованному названию (в том числе с другим порядком слов)
+# за один поиск в словаре и нечеткий поиск по триграммам для подсказок
+class FuzzyIndex:
+    def __init__(self):
+        self.exact = {}
+        self.names = []  # (нормализованное название, значение, число триграмм)
+        self.postings = {}  # триграмма -> номера названий
+        self._sorted_keys = None  # для поиска по началу названия, строится при первом запросе
+        self._sorted_values = None
+
+    @staticmethod
+    def word_order_key(name):
+        return ' '.join(sorted(name.split()))
+
+    def add(self, name, value):
+        name = normalize_name(name)
+        if not name:
+            return
+        self.exact.setdefault(name, value)
+        self.exact.setdefault(self.word_order_key(name), value)
+        grams = trigrams(name)
+        entry_id = len(self.names)
+        self.names.append((name, value, len(grams)))
+        self._sorted_keys = self._sorted_values = None
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(entry_id)
+
+    def get(self, text):
+        name = normalize_name(text)
+        value = self.exact.get(name)
+        if value is None:
+            value = self.exact.get(self.word_order_key(name))
+        return value
+
+    # Значения, названия которых начинаются с text, по алфавиту
+    def starting_with(self, text, limit=5):
+        prefix = normalize_name(text)
+        if not prefix:
+            return []
+        if self._sorted_keys is None:
+            entries = sorted(self.names, key=lambda entry: entry[0])
+            self._sorted_keys = [entry[0] for entry in entries]
+            self._sorted_values = [entry[1] for entry in entries]
+        result = []
+        position = bisect.bisect_left(self._sorted_keys, prefix)
+        while position < len(self._sorted_keys) and self._sorted_keys[position].startswith(prefix):
+            value = self._sorted_values[position]
+            if value not in result:
+                result.append(value)
+                if len(result) == limit:
+                    break
+            position += 1
+        return result
+
+    # Похожие названия по коэффициенту Дайса на триграммах, лучшие первыми
+    def suggest(self, text, limit=3, min_score=0.4):
+        grams = trigrams(normalize_name(text))
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        scored = []
+        for entry_id, count in shared.items():
+            name, value, size = self.names[entry_id]
+            score = 2 * count / (len(grams) + size)
+            if score >= min_score:
+                scored.append((score, entry_id))
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        result = []
+        for score, entry_id in scored:
+            value = self.names[entry_id][1]
+            if value not in result:
+                result.append(value)
+            if len(result) == limit:
+                break
+        return result
+
+
+def build_city_index(cities):
+    index = FuzzyIndex()
+    for city in cities:
+        index.add(city['rus_name'], city)
+        index.add(city['eng_name'], city)
+    return index
+
+
+city_index = build_city_index(city_data)
+
+
+def format_city_suggestions(name):
+    suggestions = city_index.suggest(name)
+    if not suggestions:
+        return ''
+    return ' Возможно, вы имели в виду: ' + ', '.join(city['rus_name'].replace('_', ' ') for city in suggestions) + '?'
+
 # Main menu keyboard (only for private messages)
 async def get_main_keyboard(user_id=None):
     if user_id and user_id > 0:  # Only for private messages (user_id > 0)
@@ -294,66 +1716,107 @@ async def get_main_keyboard(user_id=None):
         # Для группового чата возвращаем пустую клавиатуру
         return None  # Для группового чата возвращаем None
 
+# Команды: роутер собирается один раз при импорте (см. build_command_router в конце модуля).
+# Алиасы хранятся нормализованными: без эмодзи, слэша и упоминания бота в начале, в нижнем регистре,
+# так что "🗺️Радар", "радар" и "/радар" - один ключ словаря.
+COMMAND_PREFIX_RE = re.compile(r'^(?:\[[^\]]*\]|[^\w\[])+')  # эмодзи, слэш и упоминание "[club1|@bot]"
+CHAT_PEER_OFFSET = 2000000000  # peer_id бесед начинаются с этого числа
+
+
+def normalize_command(text):
+    return ' '.join(COMMAND_PREFIX_RE.sub('', text.strip().lower()).split())
+
+
+def route_command(text):
+    # -> (обработчик, аргумент) или (None, None); "погода Казань" -> (now_weather_handler, "Казань")
+    handler = command_router.get(text.lower())  # кнопки и команды со слэшем приходят как есть
+    if handler is not None:
+        return handler, None
+    key = normalize_command(text)
+    handler = command_router.get(key)
+    if handler is not None:
+        return handler, None
+    words = key.split(' ')
+    if len(words) < 2 or words[0] not in command_first_words:
+        return None, None
+    for count in range(min(len(words) - 1, command_max_words), 0, -1):
+        handler = command_router.get(' '.join(words[:count]))
+        if handler is not None:
+            if handler not in CITY_ARGUMENT_COMMANDS:
+                break
+            argument = COMMAND_PREFIX_RE.sub('', text.strip()).split()[count:]
+            return handler, ' '.join(argument)
+    return None, None
+
+
 @bot.on.message()
 async def message_handler(message: Message):
-    # Сначала проверяем временные обработчики
-    if await handle_temporary_state(message):
-        return
-    
-    # Проверка на флуд
-    if is_flooding(message.from_id, message.peer_id):
-        # Получаем время до окончания блокировки
-        identifier = f"{message.peer_id}_{message.from_id}"
-        user_data = user_requests[identifier]
-        remaining_time = int(user_data['block_until'] - time.time())
-        
-        if remaining_time > 0:
-            await message.answer(f"⚠️ Вы заблокированы на {remaining_time} секунд из-за частых запросов.")
+    # Сначала незавершенный диалог (ввод города и т.д.), потом команды
+    try:
+        state, params = await get_dialog(message.from_id)
+    except Exception as e:
+        print(f"[ERROR] Хранилище состояний недоступно, диалог пропущен: {e}")
+        state = params = None
+    if state is not None:
+        await dispatch_message(message, state.name, lambda: handle_dialog(message, state, params))
         return
-    
-    # Обработка основных команд
-    text = message.text.lower()
-    
-    commands = {
-        ("привет", "начать", "старт", "/start"): start_handler,
-        ("помощь", "help", "🚨помощь", "/help"): help_handler,
-        ("поддержать", "donate", "🎁поддержать", "/donate"): donate_handler,
-        ("поделиться ботом", "share", "📢поделиться ботом", "/share"): share_handler,
-        ("изменить город", "setcity", "✏️изменить город", "/setcity"): set_city_handler,
-        ("погода сейчас", "nowweather", "⛅погода сейчас", "/nowweather"): now_weather_handler,
-        ("погода на 3 дня", "forecastweather", "📆погода на 3 дня", "/forecastweather"): forecast_weather_handler,
-        ("качество воздуха", "aqi", "🌫️качество воздуха", "/aqi"): aqi_handler,
-        ("радар", "radarmap", "🗺️радар", "/radarmap"): radar_map_handler,
-        ("погода в аэропортах", "weatherairports", "✈️погода в аэропортах", "/weatherairports"): airport_weather_handler,
-        ("метеограммы гмц", "meteograms", "📊метеограммы гмц", "/meteograms"): meteograms_handler,
-        ("определить локацию", "location", "📍определить локацию"): location_handler,
-        ("угадать температуру", "guess_temp", "🎮угадать температуру", "/guess_temp"): guess_temp_handler,
-        ("метеостанции рф", "stations", "🚩метеостанции рф", "/stations"): stations_handler,
-        ("карты meteoweb", "get_meteoweb", "🌍карты meteoweb", "/get_meteoweb"): meteoweb_handler,
-        ("экстренная информация", "extrainfo", "❗экстренная информация", "/extrainfo"): extrainfo_handler,
-        ("поддержка", "support", "/support"): support_handler,
-        ("/precipitationmap",): precipitation_map_handler,
-        ("/anomaltempmap",): anomaly_temp_map_handler,
-        ("/tempwatermap",): temp_water_map_handler,
-        ("/verticaltemplayer",): vertical_temp_handler,
-        ("/firehazard_map",): fire_hazard_map_handler,
-        ("/alerts",): alerts_handler,
-        ("/weatherwebsites",): weather_websites_handler,
-    }
 
-    # Проверяем админские команды
-    if text in ["статистика", "stats", "/stats"] and message.from_id == ADMIN_ID:
-        await stats_handler(message)
+    handler, argument = route_command(message.text)
+    if handler is stats_handler and message.from_id != ADMIN_ID:
+        handler = None
+    # В беседах команда с аргументом только со слэшем: "/погода Казань", иначе это обычный разговор
+    if argument and message.peer_id >= CHAT_PEER_OFFSET and not message.text.lstrip().startswith('/'):
+        handler = None
+    if handler is None:
+        return  # обычные сообщения в беседах не тарифицируем
+    if argument:
+        await dispatch_message(message, handler.__name__, lambda: handler(message, argument))
+    else:
+        await dispatch_message(message, handler.__name__, lambda: handler(message))
+
+
+# Проверка на флуд: одно списание на сообщение или нажатие кнопки, по стоимости команды; -> сколько ждать, сек
+async def check_flood(peer_id, user_id, command):
+    started = time.perf_counter()
+    try:
+        wait = await rate_limiter.acquire(f"{peer_id}_{user_id}", command_cost(command))
+        metrics.observe('flood_check_seconds', time.perf_counter() - started)
+        metrics.inc('flood_checks_total', result='blocked' if wait > 0 else 'allowed')
+    except Exception as e:
+        metrics.inc('flood_check_errors_total')
+        print(f"[ERROR] Антифлуд недоступен, проверка пропущена: {e}")
+        wait = 0
+    if wait > 0:
+        metrics.inc('bot_flood_blocked_total')
+    return wait
+
+
+def flood_warning(wait):
+    return f"⚠️ Вы заблокированы на {int(wait) + 1} секунд из-за частых запросов."
+
+
+async def dispatch_message(message: Message, command, run):
+    wait = await check_flood(message.peer_id, message.from_id, command)
+    if wait > 0:
+        await message.answer(flood_warning(wait))
         return
-    
-    # Ищем подходящую команду
-    for cmd_tuple, handler in commands.items():
-        if text in cmd_tuple:
-            await handler(message)
+
+    with handler_metrics(command):
+        await run()
+
+
+# Антифлуд для обработчиков raw_event: та же квота, что у текстовых команд, ответ - всплывающей подсказкой
+def rate_limited(handler):
+    async def wrapper(event: MessageEvent):
+        wait = await check_flood(event.object.peer_id, event.object.user_id, handler.__name__)
+        if wait > 0:
+            await event.show_snackbar(flood_warning(wait))
             return
+        return await handler(event)
+    wrapper.__name__ = handler.__name__
+    return wrapper
     
 # Start command
-@bot.on.message(text="/start")
 @bot.on.message(payload={"cmd": "start"})
 async def start_handler(message: Message):
     log_user_activity(message.from_id, message.from_id, '/start')
@@ -364,7 +1827,6 @@ async def start_handler(message: Message):
     )
 
 # Help command
-@bot.on.message(text=["🚨Помощь", "/help"])
 async def help_handler(message: Message):
     help_text = (
         "(Техпомощь)\n\n"
@@ -398,12 +1860,10 @@ async def help_handler(message: Message):
     await message.answer(help_text)
 
 # Support command
-@bot.on.message(text=["/support"])
 async def support_handler(message: Message):
     await message.answer('🛠️ Для связи с техподдержкой напишите на нашу электронную почту: pogoda.radar@inbox.ru')
 
 # Share command
-@bot.on.message(text=["📢Поделиться ботом", "/share"])
 async def share_handler(message: Message):
     keyboard = Keyboard(inline=True)
     keyboard.add(OpenLink("https://vk.com/share.php?url=https://vk.com/pogodaradar_bot", "Поделиться ботом"))
@@ -413,7 +1873,6 @@ async def share_handler(message: Message):
     )
 
 # Donate command
-@bot.on.message(text=["🎁Поддержать", "/donate"])
 async def donate_handler(message: Message):
     donate_text = (
         "Вы можете поддержать PogodaRadar по ссылкам:\n"
@@ -424,46 +1883,34 @@ async def donate_handler(message: Message):
     await message.answer(donate_text)
 
 # Set city command
-@bot.on.message(text=["✏️Изменить город", "/setcity"])
 async def set_city_handler(message: Message):
-    user_id = message.from_id
-    clear_user_handlers(user_id)  # удаляем старый хандлер, если он есть
+    await enter_dialog(message.from_id, 'set_city')  # заменяет прежний диалог, если он был
     await message.answer('Введите название города:')
-    current_handlers[user_id] = process_set_city
 
+@dialog_state('set_city')
 async def process_set_city(message: Message):
     user_id = message.from_id
+    await end_dialog(user_id)  # ввод одноразовый
     try:
         if message.text.lower() in ["отмена", "cancel"]:
             await message.answer("❌ Отменено", keyboard=None)
-            clear_user_handlers(user_id)
             return
         city = message.text.strip()
-        save_city(user_id, city)  # сохраните в CSV или базу данных
+        await save_city(user_id, city)
         keyboard = await get_main_keyboard(message.peer_id)
         await message.answer(f"✅ Город установлен: {city}", keyboard=keyboard)
     except Exception as e:
         await message.answer("⚠️ Произошла ошибка при установке города.")
         print(f"[ERROR] {e}")
-    finally:
-        clear_user_handlers(user_id)  # всегда очищаем
 
 # Weather now command (async)
-@bot.on.message(text=["⛅Погода сейчас", "/nowweather"])
-async def now_weather_handler(message: Message):
-    if is_flooding(message.from_id):
-        await message.answer("⚠️ Вы заблокированы на 1 минуту из-за частых запросов.")
-        return
-    city = load_city(message.from_id)
+async def now_weather_handler(message: Message, city=None):
+    city = city or await load_city(message.from_id)
     if city is None:
         await message.answer('Город не установлен. Пожалуйста, сначала используйте команду /setcity, чтобы установить город.')
         return
 
-    parameters = {'key': api_key, 'q': city, 'lang': 'ru'}
-    data = await fetch_json(f'{weather_url}/current.json', params=parameters)
-
-    astronomy_parameters = {'key': api_key, 'q': city, 'lang': 'ru'}
-    astronomy_data = await fetch_json(f'{weather_url}/astronomy.json', params=astronomy_parameters)
+    data = await get_weather_snapshot(city)
 
     try:
         location = data['location']['name'] + ', ' + data['location']['country']
@@ -492,9 +1939,10 @@ async def now_weather_handler(message: Message):
         uv_index = int(data['current']['uv'])
         vis_km = data['current']['vis_km']
 
-        astronomy_data = astronomy_data or {}
-        sunrise = astronomy_data.get('astronomy', {}).get('astro', {}).get('sunrise', 'Неизвестно').replace('AM', 'Утра')
-        sunset = astronomy_data.get('astronomy', {}).get('astro', {}).get('sunset', 'Неизвестно').replace('PM', 'Вечера')
+        forecast_days = data.get('forecast', {}).get('forecastday') or [{}]
+        astro = forecast_days[0].get('astro', {})
+        sunrise = astro.get('sunrise', 'Неизвестно').replace('AM', 'Утра')
+        sunset = astro.get('sunset', 'Неизвестно').replace('PM', 'Вечера')
 
         weather_icons = {
             '1000': '☀️', '1003': '🌤️', '1006': '☁️', '1009': '☁️',
@@ -576,23 +2024,18 @@ async def now_weather_handler(message: Message):
             f'Рекомендации по одежде:\n{clothing_recommendations}'
         )
         await message.answer(weather_message, keyboard=keyboard)
-    except KeyError:
+    except (KeyError, TypeError):
         await message.answer('Не удалось получить данные о погоде для данного города. Пожалуйста, попробуйте еще раз или укажите другой город.')
 
 
 # Forecast weather command (async)
-@bot.on.message(text=["📆Погода на 3 дня", "/forecastweather"])
-async def forecast_weather_handler(message: Message):
-    if is_flooding(message.from_id):
-        await message.answer("⚠️ Вы заблокированы на 1 минуту из-за частых запросов.")
-        return
-    city = load_city(message.from_id)
+async def forecast_weather_handler(message: Message, city=None):
+    city = city or await load_city(message.from_id)
     if city is None:
         await message.answer('Город не установлен. Пожалуйста, сначала используйте команду /setcity, чтобы установить город.')
         return
 
-    parameters = {'key': api_key, 'q': city, 'days': 3, 'lang': 'ru'}
-    data = await fetch_json(f'{weather_url}/forecast.json', params=parameters)
+    data = await get_weather_snapshot(city)
 
     try:
         location = data['location']['name'] + ', ' + data['location']['country']
@@ -643,23 +2086,18 @@ async def forecast_weather_handler(message: Message):
             )
 
         await message.answer(forecast_message)
-    except KeyError:
+    except (KeyError, TypeError):
         await message.answer('Не удалось получить данные о погоде для данного города. Пожалуйста, попробуйте еще раз или укажите другой город.')
 
 
 # Air quality command (async)
-@bot.on.message(text=["🌫️Качество воздуха", "/aqi"])
-async def aqi_handler(message: Message):
-    if is_flooding(message.from_id):
-        await message.answer("⚠️ Вы заблокированы на 1 минуту из-за частых запросов.")
-        return
-    city = load_city(message.from_id)
+async def aqi_handler(message: Message, city=None):
+    city = city or await load_city(message.from_id)
     if city is None:
         await message.answer('Город не установлен. Пожалуйста, сначала используйте команду /setcity, чтобы установить город.')
         return
 
-    parameters = {'key': api_key, 'q': city, 'aqi': 'yes', 'lang': 'ru'}
-    data = await fetch_json(f'{weather_url}/current.json', params=parameters)
+    data = await get_weather_snapshot(city)
 
     try:
         location = data['location']['name'] + ', ' + data['location']['country']
@@ -682,12 +2120,11 @@ async def aqi_handler(message: Message):
             f'🏭tractorСреднее значение PM10: {pm10}'
         )
         await message.answer(aqi_message)
-    except KeyError:
+    except (KeyError, TypeError):
         await message.answer('Ошибка получения данных о качестве воздуха. Пожалуйста, попробуйте еще раз или укажите другой город.')
 
 
 # Radar map command (async) - оптимизированная версия
-@bot.on.message(text=["🗺️Радар", "/radarmap", "Радар осадков"])
 async def radar_map_handler(message: Message):
     unavailable_message = (
         "⚠️ Сервис радара временно недоступен в VK-боте\n\n"
@@ -697,147 +2134,242 @@ async def radar_map_handler(message: Message):
     )
     await message.answer(unavailable_message)
 
-# Precipitation map command (async)
-@bot.on.message(text=["/precipitationmap"])
-async def precipitation_map_handler(message: Message):
-    url = 'https://meteoinfo.ru/hmc-input/mapsynop/Precip.png'
+# Перекодирование GIF в PNG, который VK принимает как фото: в отдельном процессе, чтобы не держать цикл событий.
+# Анимация превращается в раскадровку (сетка из нескольких кадров), результат кэшируется по хэшу исходника.
+GIF_MAX_FRAMES = 4
+GIF_GRID_COLUMNS = 2
+VK_PHOTO_MAX_SIDES = 14000  # ширина + высота фото в VK
+TRANSCODE_CACHE_TTL = 24 * 3600  # сек
+transcoded_images = TTLCache(max_entries=32, max_bytes=32 * 1024 * 1024)
+transcode_flight = SingleFlight()
+metrics.register_flight('transcode', transcode_flight)
+metrics.register_cache('transcoded_images', transcoded_images)
+image_executor = None
+
+
+def gif_to_png(data, max_frames=GIF_MAX_FRAMES, columns=GIF_GRID_COLUMNS):
+    with Image.open(BytesIO(data)) as image:
+        frame_count = getattr(image, 'n_frames', 1)
+        if frame_count <= max_frames:
+            indexes = range(frame_count)
+        else:
+            # Равномерно по анимации, последний кадр обязательно
+            step = (frame_count - 1) / (max_frames - 1)
+            indexes = sorted({round(i * step) for i in range(max_frames)})
+        frames = []
+        for index, frame in enumerate(ImageSequence.Iterator(image)):
+            if index in indexes:
+                frames.append(frame.convert('RGB'))
+    width, height = frames[0].size
+    columns = min(columns, len(frames))
+    rows = (len(frames) + columns - 1) // columns
+    sheet = Image.new('RGB', (width * columns, height * rows), 'white')
+    for i, frame in enumerate(frames):
+        sheet.paste(frame, ((i % columns) * width, (i // columns) * height))
+    if sheet.width + sheet.height > VK_PHOTO_MAX_SIDES:
+        scale = VK_PHOTO_MAX_SIDES / (sheet.width + sheet.height)
+        sheet = sheet.resize((int(sheet.width * scale), int(sheet.height * scale)))
+    output = BytesIO()
+    sheet.save(output, format='PNG', optimize=True)
+    return output.getvalue()
+
+
+def get_image_executor():
+    global image_executor
+    if image_executor is None:
+        # Не fork: процесс многопоточный (aiohttp, пул разбора страниц), копия чужих блокировок может зависнуть.
+        # Дочерний процесс заново импортирует vk_bot, один раз при создании пула
+        image_executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context('spawn')
+        )
+    return image_executor
+
+
+async def _transcode_gif(digest, data):
+    loop = asyncio.get_running_loop()
+    with trace_span('transform', kind='gif_to_png', size=len(data)):
+        png = await loop.run_in_executor(get_image_executor(), gif_to_png, data)
+    transcoded_images.set(digest, png, TRANSCODE_CACHE_TTL, size=len(png))
+    return png
+
+
+async def transcode_gif(data):
+    digest = hashlib.sha256(data).hexdigest()
+    png = transcoded_images.get(digest)
+    if png is not None:
+        return png
+    return await transcode_flight.do(digest, lambda: _transcode_gif(digest, data))
+
+
+def shutdown_image_executor():
+    global image_executor
+    if image_executor is not None:
+        image_executor.shutdown(wait=False, cancel_futures=True)
+        image_executor = None
+
+
+# Статичные карты meteoinfo одинаковы для всех пользователей и меняются несколько раз в сутки:
+# фоновая задача проверяет их условным GET и держит наготове последнюю картинку и вложение VK
+STATIC_MAP_REFRESH_INTERVAL = 600  # сек
+STATIC_MAP_RETRY_INTERVAL = 60  # не чаще этого повторяем запрос после ошибки, сек
+
+
+class StaticMap:
+    def __init__(self, url, caption, doc_title=None, transcode=False):
+        self.url = url
+        self.caption = caption
+        self.doc_title = doc_title  # если не загрузится как фото, отправляем документом
+        self.transcode = transcode  # GIF: перед загрузкой перекодируем в PNG
+        self.data = None
+        self.photo_data = None  # то, что загружается фотографией (PNG после перекодирования или data)
+        self.etag = None
+        self.last_modified = None
+        self.attachment = None
+        self.checked_at = 0  # время последней успешной проверки (time.time)
+        self.attempted_at = 0
+        self.last_error = None
+
+    def needs_refresh(self):
+        now = time.time()
+        if now - self.attempted_at < STATIC_MAP_RETRY_INTERVAL and self.data is not None:
+            return False
+        return self.data is None or now - self.checked_at > STATIC_MAP_REFRESH_INTERVAL
+
+
+VERTICAL_TEMP_CAPTION = (
+    "Измерения проведены с помощью оборудования компании НПО АТТЕХ. Координаты профилемера: "
+    "ФГБУ Центральная аэрологическая обсерватория, Московская обл., г. Долгопрудный, ул. Первомайская, 3 "
+    "(55°55´32´´N, 37°31´23´´E)"
+)
+
+static_maps = {
+    'precipitation': StaticMap('https://meteoinfo.ru/hmc-input/mapsynop/Precip.png',
+                               "Карта осадков за прошедшие сутки:"),
+    'anomaly': StaticMap('https://meteoinfo.ru/images/vasiliev/anom2_6/anom2_6.gif',
+                         "Карта аномалии температуры:", doc_title="Карта аномалии температуры", transcode=True),
+    'water': StaticMap("https://meteoinfo.ru/res/230/web/esimo/black/sst/black.png",
+                       "Температура воды в Черном море:"),
+    'vertical': StaticMap("https://meteoinfo.ru/hmc-input/profiler/cao/image1.jpg", VERTICAL_TEMP_CAPTION),
+    'fire': StaticMap("https://meteoinfo.ru/images/vasiliev/plazma_ppo3.gif",
+                      "Карта пожароопасности по РФ:", doc_title="Карта пожароопасности", transcode=True),
+}
+static_map_flight = SingleFlight()
+metrics.register_flight('static_map', static_map_flight)
+
+
+async def refresh_static_map(static_map):
+    static_map.attempted_at = time.time()
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=10) as response:
-                response.raise_for_status()
-                uploader = PhotoMessageUploader(bot.api)
-                photo = await uploader.upload(
-                    file_source=BytesIO(await response.read()),
-                    peer_id=message.peer_id
-                )
-                await message.answer("Карта осадков за прошедшие сутки:", attachment=photo)
+        data, etag, last_modified = await fetch_conditional(static_map.url, static_map.etag, static_map.last_modified)
     except Exception as e:
-        await message.answer(f'Не удалось загрузить изображение: {str(e)}')
+        static_map.last_error = str(e)
+        print(f"[ERROR] Не удалось обновить карту {static_map.url}: {e}")
+        return
+    static_map.checked_at = time.time()
+    static_map.last_error = None
+    if data is None or data == static_map.data:
+        return  # 304 Not Modified или та же картинка
+    photo_data = data
+    if static_map.transcode:
+        try:
+            photo_data = await transcode_gif(data)
+        except Exception as e:
+            print(f"[ERROR] Не удалось перекодировать карту {static_map.url}: {e}")
+    # Новую картинку показываем только целиком: пока идет перекодирование, отправляется прежняя
+    static_map.data = data
+    static_map.photo_data = photo_data
+    static_map.etag = etag
+    static_map.last_modified = last_modified
+    static_map.attachment = None
+    try:
+        static_map.attachment = await upload_photo(static_map.photo_data)
+    except Exception as e:
+        print(f"[ERROR] Не удалось заранее загрузить карту {static_map.url} в VK: {e}")
+
+
+async def refresh_static_maps():
+    await asyncio.gather(*(static_map_flight.do(name, lambda m=static_map: refresh_static_map(m))
+                           for name, static_map in static_maps.items()))
+
+
+async def static_maps_refresher():
+    while True:
+        await refresh_static_maps()
+        await asyncio.sleep(STATIC_MAP_REFRESH_INTERVAL)
+
+
+def format_map_age(static_map):
+    if static_map.last_error is None:
+        return ''
+    minutes = int((time.time() - static_map.checked_at) // 60)
+    updated = datetime.fromtimestamp(static_map.checked_at).strftime('%H:%M')
+    return f"\n⚠️ Не удалось обновить карту, показана версия от {updated} ({minutes} мин назад)"
+
+
+async def send_static_map(message, name):
+    static_map = static_maps[name]
+    if static_map.needs_refresh():
+        await static_map_flight.do(name, lambda: refresh_static_map(static_map))
+    if static_map.data is None:
+        await message.answer(f'Не удалось загрузить изображение: {static_map.last_error}')
+        return
+    caption = static_map.caption + format_map_age(static_map)
+    try:
+        photo = static_map.attachment or await upload_photo(static_map.photo_data, peer_id=message.peer_id)
+        await message.answer(caption, attachment=photo)
+    except Exception as photo_error:
+        if static_map.doc_title is None:
+            await message.answer(f'Не удалось загрузить изображение: {str(photo_error)}')
+            return
+        # Если не получилось как фото, пробуем как документ
+        try:
+            uploader = DocMessagesUploader(bot.api)
+            started = time.perf_counter()
+            with trace_span('upload', kind='doc', size=len(static_map.data)):
+                doc = await uploader.upload(
+                    file_source=BytesIO(static_map.data),
+                    file_extension=static_map.url.rsplit('.', 1)[-1],
+                    peer_id=message.peer_id,
+                    title=static_map.doc_title
+                )
+            metrics.observe('vk_upload_seconds', time.perf_counter() - started, kind='doc')
+            await message.answer(caption, attachment=doc)
+        except Exception as doc_error:
+            await message.answer(f"Не удалось загрузить изображение. Ошибки: фото - {photo_error}, документ - {doc_error}")
+
+
+# Precipitation map command (async)
+async def precipitation_map_handler(message: Message):
+    await send_static_map(message, 'precipitation')
 
 
 # Temperature anomaly map command (async)
-@bot.on.message(text=["/anomaltempmap"])
 async def anomaly_temp_map_handler(message: Message):
-    url = 'https://meteoinfo.ru/images/vasiliev/anom2_6/anom2_6.gif'
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=10) as response:
-                response.raise_for_status()
-                image_data = await response.read()
-                
-                # Сначала пробуем загрузить как фото
-                try:
-                    uploader = PhotoMessageUploader(bot.api)
-                    photo = await uploader.upload(
-                        file_source=BytesIO(image_data),
-                        peer_id=message.peer_id
-                    )
-                    await message.answer("Карта аномалии температуры:", attachment=photo)
-                except Exception as photo_error:
-                    # Если не получилось как фото, пробуем как документ
-                    try:
-                        uploader = DocMessagesUploader(bot.api)
-                        doc = await uploader.upload(
-                            file_source=BytesIO(image_data),
-                            file_extension="png",  # Пробуем как PNG, даже если исходно GIF
-                            peer_id=message.peer_id,
-                            title="Карта аномалии температуры"
-                        )
-                        await message.answer("Карта аномалии температуры:", attachment=doc)
-                    except Exception as doc_error:
-                        await message.answer(f"Не удалось загрузить изображение. Ошибки: фото - {photo_error}, документ - {doc_error}")
-                        
-    except Exception as e:
-        await message.answer(f'Ошибка при получении изображения: {str(e)}')
+    await send_static_map(message, 'anomaly')
 
 
 # Water temperature map command (async)
-@bot.on.message(text=["/tempwatermap"])
 async def temp_water_map_handler(message: Message):
-    url = "https://meteoinfo.ru/res/230/web/esimo/black/sst/black.png"
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=10) as response:
-                response.raise_for_status()
-                uploader = PhotoMessageUploader(bot.api)
-                photo = await uploader.upload(
-                    file_source=BytesIO(await response.read()),
-                    peer_id=message.peer_id
-                )
-                await message.answer("Температура воды в Черном море:", attachment=photo)
-    except Exception as e:
-        await message.answer(f'Не удалось загрузить изображение: {str(e)}')
+    await send_static_map(message, 'water')
 
 
 # Vertical temperature layer command (async)
-@bot.on.message(text=["/verticaltemplayer"])
 async def vertical_temp_handler(message: Message):
-    url = "https://meteoinfo.ru/hmc-input/profiler/cao/image1.jpg"
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=10) as response:
-                response.raise_for_status()
-                uploader = PhotoMessageUploader(bot.api)
-                photo = await uploader.upload(
-                    file_source=BytesIO(await response.read()),
-                    peer_id=message.peer_id
-                )
-                caption = ("Измерения проведены с помощью оборудования компании НПО АТТЕХ. Координаты профилемера: "
-                            "ФГБУ Центральная аэрологическая обсерватория, Московская обл., г. Долгопрудный, ул. Первомайская, 3 "
-                            "(55°55´32´´N, 37°31´23´´E)")
-                await message.answer(caption, attachment=photo)
-    except Exception as e:
-        await message.answer(f'Не удалось загрузить изображение: {str(e)}')
+    await send_static_map(message, 'vertical')
 
 
 # Fire hazard map command (async)
-@bot.on.message(text=["/firehazard_map"])
 async def fire_hazard_map_handler(message: Message):
-    url = "https://meteoinfo.ru/images/vasiliev/plazma_ppo3.gif"
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=10) as response:
-                response.raise_for_status()
-                image_data = await response.read()
-                
-                # Сначала пробуем загрузить как фото
-                try:
-                    uploader = PhotoMessageUploader(bot.api)
-                    photo = await uploader.upload(
-                        file_source=BytesIO(image_data),
-                        peer_id=message.peer_id
-                    )
-                    await message.answer("Карта пожароопасности по РФ:", attachment=photo)
-                except Exception as photo_error:
-                    # Если не получилось как фото, пробуем как документ
-                    try:
-                        uploader = DocMessagesUploader(bot.api)
-                        doc = await uploader.upload(
-                            file_source=BytesIO(image_data),
-                            file_extension="png",  # Пробуем как PNG, даже если исходно GIF
-                            peer_id=message.peer_id,
-                            title="Карта пожароопасности"
-                        )
-                        await message.answer("Карта пожароопасности по РФ:", attachment=doc)
-                    except Exception as doc_error:
-                        await message.answer(f"Не удалось загрузить изображение. Ошибки: фото - {photo_error}, документ - {doc_error}")
-                        
-    except Exception as e:
-        await message.answer(f'Ошибка при получении изображения: {str(e)}')
+    await send_static_map(message, 'fire')
 
 # Alerts command (async)
-@bot.on.message(text=["/alerts"])
-async def alerts_handler(message: Message):
-    if is_flooding(message.from_id):
-        await message.answer("⚠️ Вы заблокированы на 1 минуту из-за частых запросов.")
-        return
-    city = load_city(message.from_id)
+async def alerts_handler(message: Message, city=None):
+    city = city or await load_city(message.from_id)
     if city is None:
         await message.answer('Город не установлен. Пожалуйста, сначала используйте команду /setcity, чтобы установить город.')
         return
 
-    parameters = {'key': api_key, 'q': city, 'days': 1, 'alerts': 'yes', 'lang': 'ru'}
-    data = await fetch_json(f'{weather_url}/forecast.json', params=parameters)
+    data = await get_weather_snapshot(city)
 
     try:
         location = data['location']['name'] + ', ' + data['location']['country']
@@ -877,7 +2409,6 @@ async def alerts_handler(message: Message):
         await message.answer(f'Произошла ошибка: {str(e)}')
 
 # Weather websites command (no external request needed)
-@bot.on.message(text=["/weatherwebsites"])
 async def weather_websites_handler(message: Message):
     websites_text = (
         "Полезные сайты для просмотра погоды:\n"
@@ -888,8 +2419,9 @@ async def weather_websites_handler(message: Message):
     await message.answer(websites_text)
 
 # Airport weather command
-def get_icao_code_by_name(airport_name):
-    airports = {
+# Авиапогода: индекс аэропортов строится один раз, сводки METAR/TAF с metartaf.ru кэшируются
+# до выхода следующей сводки (METAR раз в 30 минут, TAF раз в 6 часов).
+AIRPORTS = {
         # Russia
         "шереметьево": "UUEE", "домодедово": "UUDD", "внуково": "UUWW",
         "жуковский": "UUBW", "абакан": "UNAA", "анадырь": "UHMA",
@@ -925,55 +2457,165 @@ def get_icao_code_by_name(airport_name):
         "минск": "UMMS", "минск-1": "UMMM", "брест": "UMBB",
         "витебск": "UMII", "гомель": "UMGG", "гродно": "UMMG",
         "могилев": "UMOO",
-    }
-    return airports.get(airport_name.lower())
+}
+AIRPORT_NAMES = {code: name for name, code in AIRPORTS.items()}
+METAR_INTERVAL = 30 * 60  # сек
+TAF_INTERVAL = 6 * 3600  # сек
+AVIATION_PUBLISH_DELAY = 5 * 60  # новая сводка появляется на metartaf.ru не сразу, сек
+AVIATION_LATE_TTL = 2 * 60  # сводка уже должна была обновиться, но еще нет: перепроверяем чаще, сек
+AVIATION_DEFAULT_TTL = 10 * 60  # время выпуска не разобрано, сек
+AVIATION_REFRESH_INTERVAL = 60  # сек
+AVIATION_PREFETCH_TOP = 20  # сколько самых запрашиваемых аэропортов держать свежими
+AVIATION_PREFETCH_SEED = ('UUEE', 'UUDD', 'UUWW', 'ULLI')
+AVIATION_COUNTER_DECAY = 6 * 3600  # раз в столько счетчики запросов делятся пополам, сек
+REPORT_TIME_RE = re.compile(r'\b(\d{2})(\d{2})(\d{2})Z\b')
+
+
+def build_airport_index(airports):
+    index = FuzzyIndex()
+    for name, code in airports.items():
+        index.add(name, code)
+    return index
+
+
+airport_index = build_airport_index(AIRPORTS)
+airport_reports = TTLCache(max_entries=500)  # ICAO -> ответ metartaf.ru
+metrics.register_cache('airport_reports', airport_reports)
+airport_requests = Counter()  # ICAO -> сколько раз спрашивали
+
+
+def get_icao_code_by_name(airport_name):
+    code = airport_index.get(airport_name)
+    if code is None:
+        # Однозначное начало названия: "шерем" -> UUEE
+        matches = airport_index.starting_with(airport_name, limit=2)
+        if len(matches) == 1:
+            code = matches[0]
+    return code
+
+
+def format_airport_suggestions(airport_name):
+    codes = airport_index.starting_with(airport_name) or airport_index.suggest(airport_name)
+    if not codes:
+        return ''
+    return ' Возможно, вы имели в виду: ' + ', '.join(f"{AIRPORT_NAMES[code].capitalize()} ({code})" for code in codes) + '?'
+
+
+def report_issued_at(report, now):
+    # "UUEE 171230Z ..." -> unix time выпуска (день месяца, часы и минуты UTC)
+    match = REPORT_TIME_RE.search(report or '')
+    if not match:
+        return None
+    day, hour, minute = map(int, match.groups())
+    current = datetime.fromtimestamp(now, timezone.utc)
+    year, month = current.year, current.month
+    if day > current.day:  # сводка за прошлый месяц
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    try:
+        return datetime(year, month, day, hour, minute, tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+def airport_report_ttl(data, now=None):
+    now = now if now is not None else time.time()
+    expiries = []
+    metar_issued = report_issued_at(data.get('metar'), now)
+    if metar_issued is not None:
+        expiries.append(metar_issued + METAR_INTERVAL + AVIATION_PUBLISH_DELAY)
+    taf_issued = report_issued_at(data.get('taf'), now)
+    if taf_issued is not None:
+        expiries.append(taf_issued + TAF_INTERVAL + AVIATION_PUBLISH_DELAY)
+    if not expiries:
+        return AVIATION_DEFAULT_TTL
+    ttl = min(expiries) - now
+    return min(ttl, METAR_INTERVAL + AVIATION_PUBLISH_DELAY) if ttl > 0 else AVIATION_LATE_TTL
+
+
+async def _fetch_airport_report(code):
+    body = await _fetch_bytes(f'https://metartaf.ru/{code}.json')
+    data = json.loads(body)
+    if data:
+        airport_reports.set(code, data, airport_report_ttl(data), size=len(body))
+    return data
+
+
+async def get_airport_report(code, count=True):
+    if count:
+        airport_requests[code] += 1
+    data = airport_reports.get(code)
+    if data is not None:
+        return data
+    try:
+        return await upstream_flight.do(('metartaf', code), lambda: _fetch_airport_report(code))
+    except Exception as e:
+        print(f"Request error: {e}")
+        return None
+
+
+# Самые запрашиваемые аэропорты обновляются заранее, как только их сводка устаревает
+async def airport_reports_refresher():
+    decayed_at = time.monotonic()
+    while True:
+        if time.monotonic() - decayed_at > AVIATION_COUNTER_DECAY:
+            for code in list(airport_requests):
+                airport_requests[code] //= 2
+                if not airport_requests[code]:
+                    del airport_requests[code]
+            decayed_at = time.monotonic()
+        codes = list(AVIATION_PREFETCH_SEED)
+        codes += [code for code, _ in airport_requests.most_common(AVIATION_PREFETCH_TOP) if code not in codes]
+        for code in codes:
+            remaining = airport_reports.ttl(code)
+            if remaining is None or remaining < AVIATION_REFRESH_INTERVAL:
+                try:
+                    await upstream_flight.do(('metartaf', code), lambda: _fetch_airport_report(code))
+                except Exception as e:
+                    print(f"[ERROR] Не удалось обновить сводку {code}: {e}")
+        await asyncio.sleep(AVIATION_REFRESH_INTERVAL)
+
+async def airport_weather_handler(message: Message):
+    await enter_dialog(message.from_id, 'airport')
+    await message.answer('Введите код ICAO (например, UUEE) или название аэропорта (например, Шереметьево). Для отмены введите "отмена"')
+
+
+@dialog_state('airport')
+async def process_airport_input(msg: Message):
+    await end_dialog(msg.from_id)  # ввод одноразовый
+    if msg.text.lower() in ["отмена", "cancel"]:
+        await msg.answer("❌ Отменено")
+        return
+
+    input_text = msg.text.strip()
+
+    # Проверяем, является ли ввод ICAO кодом (4 латинские буквы): "Омск" или "Сочи" - названия, не коды
+    if len(input_text) == 4 and input_text.isascii() and input_text.isalpha():
+        airport_code = input_text.upper()
+    else:
+        # Иначе ищем по названию
+        airport_code = get_icao_code_by_name(input_text)
+        if not airport_code:
+            await msg.answer("Не удалось найти аэропорт. Попробуйте ввести ICAO код (4 буквы) или название аэропорта из списка." + format_airport_suggestions(input_text))
+            return
+
+    data = await get_airport_report(airport_code)
+
+    if data:
+        weather_info = (
+            f"🌐 Кодировка аэропорта: {data['icao']}\n"
+            f"✈️ Погодные условия в аэропорту: {data['name']}\n"
+            f"📍 METAR-сводка по аэропорту: `{data['metar']}`\n"
+            f"🌀 TAF-прогноз по аэропорту: `{data['taf']}`"
+        )
+        keyboard = Keyboard(inline=True)
+        keyboard.add(Callback("Как расшифровать данные?", {"cmd": "decode_airport"}))
+        await msg.answer(weather_info, keyboard=keyboard)
+    else:
+        await msg.answer("Ошибка получения данных о погоде. Проверьте правильность кода аэропорта.")
 
-@bot.on.message(text=["✈️Погода в аэропортах", "/weatherairports"])
-async def airport_weather_handler(message: Message):
-    clear_user_handlers(message.from_id)
-    await message.answer('Введите код ICAO (например, UUEE) или название аэропорта (например, Шереметьево). Для отмены введите "отмена"')
-    
-    async def process_airport_input(msg: Message):
-        try:
-            if msg.text.lower() in ["отмена", "cancel"]:
-                await msg.answer("❌ Отменено")
-                clear_user_handlers(msg.from_id)
-                return
-            
-            input_text = msg.text.strip()
-            
-            # Проверяем, является ли ввод ICAO кодом (4 заглавные буквы)
-            if len(input_text) == 4 and input_text.upper().isalpha():
-                airport_code = input_text.upper()
-            else:
-                # Иначе ищем по названию
-                airport_code = get_icao_code_by_name(input_text)
-                if not airport_code:
-                    await msg.answer("Не удалось найти аэропорт. Попробуйте ввести ICAO код (4 буквы) или название аэропорта из списка.")
-                    return
-
-            url = f'https://metartaf.ru/{airport_code}.json'
-            data = await fetch_json(url)
-
-            if data:
-                weather_info = (
-                    f"🌐 Кодировка аэропорта: {data['icao']}\n"
-                    f"✈️ Погодные условия в аэропорту: {data['name']}\n"
-                    f"📍 METAR-сводка по аэропорту: `{data['metar']}`\n"
-                    f"🌀 TAF-прогноз по аэропорту: `{data['taf']}`"
-                )
-                keyboard = Keyboard(inline=True)
-                keyboard.add(Callback("Как расшифровать данные?", {"cmd": "decode_airport"}))
-                await msg.answer(weather_info, keyboard=keyboard)
-            else:
-                await msg.answer("Ошибка получения данных о погоде. Проверьте правильность кода аэропорта.")
-        finally:
-            clear_user_handlers(msg.from_id)
-    
-    current_handlers[message.from_id] = process_airport_input
-    process_airport_input.once = True
 
 @bot.on.raw_event(GroupEventType.MESSAGE_EVENT, MessageEvent, payload_contains={"cmd": "decode_airport"})
+@instrumented
 async def handle_decode_airport(event: MessageEvent):
     # Подтверждаем получение события
     try:
@@ -1011,14 +2653,35 @@ async def handle_decode_airport(event: MessageEvent):
     )
 
 # Meteograms command
-@bot.on.message(text=["📊Метеограммы ГМЦ", "/meteograms"])
 async def meteograms_handler(message: Message):
     keyboard = Keyboard(inline=True)
     keyboard.add(Callback("Один город", {"cmd": "meteo_one_city"}))
     keyboard.add(Callback("Несколько городов", {"cmd": "meteo_several_cities"}))
     await message.answer("Выберите режим:", keyboard=keyboard)
 
+# Скачивания с одного хоста ограничены семафором (общим для всех пользователей),
+# загрузка в VK начинается сразу после скачивания и идет параллельно со следующими скачиваниями
+METEOGRAM_HOST_CONCURRENCY = 4
+host_semaphores = {}
+
+
+def get_host_semaphore(url, limit):
+    host = yarl.URL(url).host
+    semaphore = host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = host_semaphores[host] = asyncio.Semaphore(limit)
+    return semaphore
+
+
+async def load_meteogram(city_info, peer_id):
+    async with get_host_semaphore(city_info['url'], METEOGRAM_HOST_CONCURRENCY):
+        image_data = await fetch_bytes(city_info['url'])
+    return await upload_photo(image_data, peer_id=peer_id)
+
+
 @bot.on.raw_event(GroupEventType.MESSAGE_EVENT, MessageEvent, payload_contains={"cmd": "meteo_one_city"})
+@rate_limited
+@instrumented
 async def handle_meteo_one_city(event: MessageEvent):
     user_id = event.object.user_id
     peer_id = event.object.peer_id
@@ -1034,6 +2697,9 @@ async def handle_meteo_one_city(event: MessageEvent):
         print(f"[ERROR] Ошибка подтверждения callback: {e}")
     
     try:
+        # Следующее сообщение пользователя - ввод для диалога
+        await enter_dialog(user_id, 'meteo_one_city')
+        
         # Отправляем сообщение пользователю
         await bot.api.messages.send(
             peer_id=peer_id,
@@ -1041,54 +2707,6 @@ async def handle_meteo_one_city(event: MessageEvent):
             random_id=0
         )
         
-        # Устанавливаем обработчик для следующего сообщения
-        async def process_city_input(msg: Message):
-            try:
-                if msg.text.lower() in ["отмена", "cancel"]:
-                    await msg.answer("❌ Отменено")
-                    return
-                
-                city_name = msg.text.strip().upper()
-                city_info = next((city for city in city_data if city['rus_name'].upper() == city_name or city['eng_name'].upper() == city_name), None)
-
-                if not city_info:
-                    await msg.answer("Город не найден. Попробуйте еще раз.")
-                    return
-
-                # Начинаем замер времени
-                start_time = time.time()
-                
-                # Загружаем изображение
-                try:
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(city_info['url'], timeout=ClientTimeout(total=30)) as response:
-                            if response.status == 200:
-                                image_data = await response.read()
-                                uploader = PhotoMessageUploader(bot.api)
-                                photo = await uploader.upload(
-                                    file_source=BytesIO(image_data),
-                                    peer_id=msg.peer_id
-                                )
-                                
-                                # Вычисляем затраченное время
-                                elapsed_time = round(time.time() - start_time, 2)
-                                
-                                await msg.answer(
-                                    f'📊 Прогноз на 5 дней для города: {city_info["rus_name"]}\n'
-                                    f'⏱️ Время загрузки: {elapsed_time} сек.',
-                                    attachment=photo
-                                )
-                            else:
-                                await msg.answer(f"❌ Не удалось загрузить метеограмму для города {city_info['rus_name']}")
-                except Exception as e:
-                    await msg.answer(f"❌ Ошибка при загрузке изображения: {str(e)}")
-                    
-            finally:
-                clear_user_handlers(msg.from_id)
-        
-        current_handlers[user_id] = process_city_input
-        process_city_input.once = True
-        
     except Exception as e:
         print(f"[ERROR] Error in handle_meteo_one_city: {e}")
         await bot.api.messages.send(
@@ -1097,7 +2715,45 @@ async def handle_meteo_one_city(event: MessageEvent):
             random_id=0
         )
 
+
+@dialog_state('meteo_one_city')
+async def process_city_input(msg: Message):
+    await end_dialog(msg.from_id)  # ввод одноразовый
+    if msg.text.lower() in ["отмена", "cancel"]:
+        await msg.answer("❌ Отменено")
+        return
+
+    city_info = city_index.get(msg.text)
+
+    if not city_info:
+        await msg.answer("Город не найден. Попробуйте еще раз." + format_city_suggestions(msg.text))
+        return
+
+    # Начинаем замер времени
+    start_time = time.time()
+
+    # Загружаем изображение
+    try:
+        photo = await load_meteogram(city_info, msg.peer_id)
+
+        # Вычисляем затраченное время
+        elapsed_time = round(time.time() - start_time, 2)
+
+        await msg.answer(
+            f'📊 Прогноз на 5 дней для города: {city_info["rus_name"]}\n'
+            f'⏱️ Время загрузки: {elapsed_time} сек.',
+            attachment=photo
+        )
+    except aiohttp.ClientResponseError:
+        await msg.answer(f"❌ Не удалось загрузить метеограмму для города {city_info['rus_name']}")
+    except Exception as e:
+        await msg.answer(f"❌ Ошибка при загрузке изображения: {str(e)}")
+
+
+
 @bot.on.raw_event(GroupEventType.MESSAGE_EVENT, MessageEvent, payload_contains={"cmd": "meteo_several_cities"})
+@rate_limited
+@instrumented
 async def handle_meteo_several_cities(event: MessageEvent):
     user_id = event.object.user_id
     peer_id = event.object.peer_id
@@ -1113,6 +2769,9 @@ async def handle_meteo_several_cities(event: MessageEvent):
         print(f"[ERROR] Ошибка подтверждения callback: {e}")
     
     try:
+        # Следующее сообщение пользователя - ввод для диалога
+        await enter_dialog(user_id, 'meteo_several_cities')
+        
         # Отправляем сообщение пользователю
         await bot.api.messages.send(
             peer_id=peer_id,
@@ -1120,70 +2779,6 @@ async def handle_meteo_several_cities(event: MessageEvent):
             random_id=0
         )
         
-        # Устанавливаем обработчик для следующего сообщения
-        async def process_cities_input(msg: Message):
-            try:
-                if msg.text.lower() in ["отмена", "cancel"]:
-                    await msg.answer("❌ Отменено")
-                    return
-                
-                cities = [city.strip().upper() for city in msg.text.split(',') if city.strip()][:10]
-                found_cities = []
-                
-                for city_name in cities:
-                    city_info = next((city for city in city_data if city['rus_name'].upper() == city_name or city['eng_name'].upper() == city_name), None)
-                    if city_info:
-                        found_cities.append(city_info)
-                
-                if not found_cities:
-                    await msg.answer("Ни один из указанных городов не найден.")
-                    return
-                
-                # Начинаем общий замер времени
-                total_start_time = time.time()
-                successful_cities = 0
-                
-                # Загружаем и отправляем метеограммы
-                for city in found_cities:
-                    try:
-                        city_start_time = time.time()
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(city['url'], timeout=ClientTimeout(total=30)) as response:
-                                if response.status == 200:
-                                    image_data = await response.read()
-                                    uploader = PhotoMessageUploader(bot.api)
-                                    photo = await uploader.upload(
-                                        file_source=BytesIO(image_data),
-                                        peer_id=msg.peer_id
-                                    )
-                                    
-                                    city_elapsed_time = round(time.time() - city_start_time, 2)
-                                    
-                                    await msg.answer(
-                                        f'📊 Прогноз на 5 дней для города: {city["rus_name"]}\n'
-                                        f'⏱️ Время загрузки: {city_elapsed_time} сек.',
-                                        attachment=photo
-                                    )
-                                    successful_cities += 1
-                                else:
-                                    await msg.answer(f"❌ Не удалось загрузить метеограмму для города {city['rus_name']}")
-                    except Exception as e:
-                        await msg.answer(f"❌ Ошибка при загрузке метеограммы для {city['rus_name']}: {str(e)}")
-                
-                # Общее время выполнения
-                total_elapsed_time = round(time.time() - total_start_time, 2)
-                
-                await msg.answer(
-                    f"✅ Готово!\n"
-                    f"📊 Успешно загружено: {successful_cities} из {len(found_cities)}\n"
-                    f"⏱️ Общее время: {total_elapsed_time} сек."
-                )
-            finally:
-                clear_user_handlers(msg.from_id)
-        
-        current_handlers[user_id] = process_cities_input
-        process_cities_input.once = True
-        
     except Exception as e:
         print(f"[ERROR] Error in handle_meteo_several_cities: {e}")
         await bot.api.messages.send(
@@ -1192,6 +2787,69 @@ async def handle_meteo_several_cities(event: MessageEvent):
             random_id=0
         )
 
+
+@dialog_state('meteo_several_cities')
+async def process_cities_input(msg: Message):
+    await end_dialog(msg.from_id)  # ввод одноразовый
+    if msg.text.lower() in ["отмена", "cancel"]:
+        await msg.answer("❌ Отменено")
+        return
+
+    cities = [city.strip() for city in msg.text.split(',') if city.strip()][:10]
+    found_cities = []
+    not_found = []
+
+    for city_name in cities:
+        city_info = city_index.get(city_name)
+        if city_info:
+            found_cities.append(city_info)
+        else:
+            not_found.append(city_name)
+
+    if not found_cities:
+        await msg.answer("Ни один из указанных городов не найден." + format_city_suggestions(cities[0] if cities else ''))
+        return
+    if not_found:
+        await msg.answer("\n".join(f"❓ {name}: город не найден.{format_city_suggestions(name)}" for name in not_found))
+
+    # Начинаем общий замер времени
+    total_start_time = time.time()
+    successful_cities = 0
+
+    # Скачиваем и загружаем все метеограммы параллельно, а отправляем в порядке ввода:
+    # каждая уходит, как только готова она и все предыдущие
+    tasks = [asyncio.ensure_future(load_meteogram(city, msg.peer_id)) for city in found_cities]
+    try:
+        for city, task in zip(found_cities, tasks):
+            try:
+                photo = await task
+
+                city_elapsed_time = round(time.time() - total_start_time, 2)
+
+                await msg.answer(
+                    f'📊 Прогноз на 5 дней для города: {city["rus_name"]}\n'
+                    f'⏱️ Время загрузки: {city_elapsed_time} сек.',
+                    attachment=photo
+                )
+                successful_cities += 1
+            except aiohttp.ClientResponseError:
+                await msg.answer(f"❌ Не удалось загрузить метеограмму для города {city['rus_name']}")
+            except Exception as e:
+                await msg.answer(f"❌ Ошибка при загрузке метеограммы для {city['rus_name']}: {str(e)}")
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    # Общее время выполнения
+    total_elapsed_time = round(time.time() - total_start_time, 2)
+
+    await msg.answer(
+        f"✅ Готово!\n"
+        f"📊 Успешно загружено: {successful_cities} из {len(found_cities)}\n"
+        f"⏱️ Общее время: {total_elapsed_time} сек."
+    )
+
+
 # Meteoweb maps command (async)
 type_mapping = {
     "prec": ("prec", "🌧️ Осадки"),
@@ -1205,7 +2863,6 @@ type_mapping = {
     "tef": ("tef", "🌡️ Эффективная температура")
 }
 
-@bot.on.message(text=["/get_meteoweb", "Карты погоды"])
 async def meteoweb_handler(message: Message):
     unavailable_message = (
         "⚠️ Сервис временно недоступен в VK-боте\n\n"
@@ -1226,40 +2883,95 @@ def calculate_forecast_time(run_time, forecast_hour):
     return forecast_date.strftime("%Y-%m-%d %H:%M") + " UTC"
 
 
+# Разбор страниц meteoinfo: lxml в пуле потоков (lxml отпускает GIL на время разбора), чтобы не
+# останавливать цикл событий. Кэшируется уже извлеченный результат, а не HTML.
+EXTRAINFO_CACHE_TTL = 600  # сек
+STATION_CACHE_TTL = 600  # сек
+parsed_pages = TTLCache(max_entries=1000)
+metrics.register_cache('parsed_pages', parsed_pages)
+parse_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='html-parse')
+parse_flight = SingleFlight()
+metrics.register_flight('parse', parse_flight)
+
+
+def parse_html(html):
+    return lxml.html.fromstring(html.encode('utf-8'), parser=lxml.html.HTMLParser(encoding='utf-8'))
+
+
+# Текст ячейки без пробелов по краям каждого фрагмента (как get_text(strip=True) в BeautifulSoup)
+def cell_text(element):
+    return ''.join(part.strip() for part in element.itertext())
+
+
+def parse_extrainfo_page(html):
+    root = parse_html(html)
+    page_header = root.xpath('//div[contains(concat(" ", normalize-space(@class), " "), " page-header ")]')
+    headline = page_header[0].xpath('.//h1') if page_header else []
+    headline = headline[0].text_content().strip() if headline else "Экстренная информация"
+
+    extrainfo = []
+    for block in root.xpath('//div[@id="div_1"]'):
+        for row in block.iter('tr'):
+            cell_texts = [cell_text(cell) for cell in row.iter('td')]
+            if cell_texts:
+                extrainfo.append(" | ".join(cell_texts))
+
+    additional_info = []
+    div_2 = root.xpath('//div[@id="div_2"]')
+    if div_2:
+        for row in div_2[0].iter('tr'):
+            cell = next(row.iter('td'), None)
+            if cell is not None and cell.text_content().strip():
+                additional_info.append(cell.text_content().strip())
+
+    return {
+        'headline': headline,
+        'extrainfo': extrainfo[:7] or ["Нет экстренной информации."],
+        'additional_info': additional_info,
+    }
+
+
+def parse_station_page(html):
+    root = parse_html(html)
+    update_time = root.xpath('//td[@colspan="2" and @align="right"]')
+    update_time = update_time[0].text_content().strip() if update_time else "Нет данных о времени обновления"
+
+    table = root.xpath('//table[@border="0" and @style="width:100%"]')
+    weather_data = None
+    if table:
+        weather_data = {}
+        for row in table[0].iter('tr'):
+            columns = list(row.iter('td'))
+            if len(columns) == 2:
+                weather_data[columns[0].text_content().strip()] = columns[1].text_content().strip()
+    return {'update_time': update_time, 'weather_data': weather_data}
+
+
+async def _fetch_parsed(key, url, parser, ttl):
+    html = await fetch_text(url)
+    loop = asyncio.get_running_loop()
+    with trace_span('parse', parser=parser.__name__, size=len(html)):
+        result = await loop.run_in_executor(parse_executor, parser, html)
+    parsed_pages.set(key, result, ttl)
+    return result
+
+
+async def fetch_parsed(url, parser, ttl):
+    key = (parser.__name__, url)
+    result = parsed_pages.get(key)
+    if result is not None:
+        return result
+    return await parse_flight.do(key, lambda: _fetch_parsed(key, url, parser, ttl))
+
+
 # Extra info command (async)
-@bot.on.message(text=["/extrainfo"])
 async def extrainfo_handler(message: Message):
     url = 'https://meteoinfo.ru/extrainfopage'
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=10) as response:
-                response.raise_for_status()
-                text = await response.text()
-        soup = BeautifulSoup(text, 'html.parser')
-        page_header = soup.find('div', class_='page-header')
-        headline = page_header.find('h1').text.strip() if page_header and page_header.find('h1') else "Экстренная информация"
-
-        extrainfo = []
-        info_blocks = soup.find_all('div', id='div_1')
-        for block in info_blocks:
-            rows = block.find_all('tr')
-            for row in rows:
-                cells = row.find_all('td')
-                cell_texts = [cell.get_text(strip=True) for cell in cells]
-                if cell_texts:
-                    extrainfo.append(" | ".join(cell_texts))
-
-        extrainfo = extrainfo[:7] or ["Нет экстренной информации."]
-
-        additional_info = []
-        div_2 = soup.find('div', id='div_2')
-        if div_2:
-            for row in div_2.find_all('tr'):
-                cell = row.find('td')
-                if cell and cell.text.strip():
-                    additional_info.append(cell.text.strip())
-
-        combined_message = f"⚠️ {headline} ⚠️\n" + "\n".join(extrainfo)
+        page = await fetch_parsed(url, parse_extrainfo_page, EXTRAINFO_CACHE_TTL)
+
+        combined_message = f"⚠️ {page['headline']} ⚠️\n" + "\n".join(page['extrainfo'])
+        additional_info = page['additional_info']
         combined_message += "\n— — —\n" + ("\n".join(additional_info) if additional_info else "Нет дополнительной информации.")
         await message.answer(combined_message)
     except Exception as e:
@@ -1599,33 +3311,369 @@ stations_dict = {
     "чулпаново": "chulpanovo"
 }
 
+# Коды -> названия для подписей; если у кода несколько названий, берем первое
+station_names = {}
+for name, code in stations_dict.items():
+    station_names.setdefault(code, name)
+region_names = {}
+for name, code in regions_dict.items():
+    region_names.setdefault(code, name)
+
+
+# "регион/станция" -> "Клин (Московская область)"
+def station_display_name(key):
+    region_code, _, station_code = key.partition('/')
+    name = station_names.get(station_code, station_code).capitalize()
+    region = region_names.get(region_code)
+    return f"{name} ({region.capitalize()})" if region else name
+
+# Наблюдения метеостанций: краулер обходит все известные станции после каждого синоптического срока
+# (00, 03, ..., 21 UTC) и складывает разобранные данные в локальное хранилище, /stations отвечает из него.
+# Пары регион/станция берутся со страниц регионов meteoinfo (ссылки на станции из stations_dict)
+# и из успешных запросов пользователей.
+STATIONS_FILE = 'stations_observations.json'
+STATION_OBSERVATION_MAX_AGE = 4 * 3600  # старше этого идем на сайт при запросе, сек
+STATION_CRAWL_TERM_HOURS = 3  # синоптические сроки, часов
+STATION_CRAWL_DELAY = 40 * 60  # данные появляются на сайте не сразу после срока, сек
+STATION_CRAWL_CONCURRENCY = 2
+STATION_CRAWL_PAUSE = 1.0  # пауза между запросами одного потока краулера, сек
+STATION_DISCOVERY_INTERVAL = 24 * 3600  # как часто заново читаем страницы регионов, сек
+STATION_SERIES_CAPACITY = 128  # точек на станцию и величину: ~16 суток по срокам краулера
+STATION_SERIES_VARIABLES = {
+    'temperature': 'Температура воздуха, °C',
+    'pressure': 'Атмосферное давление на уровне станции, мм рт.ст.',
+}
+MSK = timezone(timedelta(hours=3))
+STATION_URL = "https://meteoinfo.ru/pogoda/russia/{region}/{station}"
+REGION_URL = "https://meteoinfo.ru/pogoda/russia/{region}"
+
+
+# Кольцевой буфер одной величины: время и значения в упакованных массивах double фиксированного размера
+class RingSeries:
+    __slots__ = ('times', 'values', 'start', 'count')
+
+    def __init__(self, capacity):
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def last_time(self):
+        if not self.count:
+            return None
+        return self.times[(self.start + self.count - 1) % len(self.times)]
+
+    def append(self, timestamp, value):
+        last = self.last_time()
+        if last is not None and timestamp <= last:
+            return False  # это наблюдение уже есть
+        capacity = len(self.times)
+        if self.count < capacity:
+            index = (self.start + self.count) % capacity
+            self.count += 1
+        else:
+            index = self.start
+            self.start = (self.start + 1) % capacity
+        self.times[index] = timestamp
+        self.values[index] = value
+        return True
+
+    def _ordered(self, data):
+        end = self.start + self.count
+        if end <= len(data):
+            return data[self.start:end]
+        return data[self.start:] + data[:end - len(data)]
+
+    def window(self, since):
+        times = self._ordered(self.times)
+        values = self._ordered(self.values)
+        first = bisect.bisect_left(times, since)
+        return times[first:], values[first:]
+
+    @staticmethod
+    def summary(values):
+        if not values:
+            return None
+        return min(values), max(values), math.fsum(values) / len(values)
+
+    def to_json(self):
+        return [self._ordered(self.times).tolist(), self._ordered(self.values).tolist()]
+
+    @classmethod
+    def from_json(cls, capacity, data):
+        series = cls(capacity)
+        for timestamp, value in zip(*data):
+            series.append(timestamp, value)
+        return series
+
+
+def parse_observation_time(update_time):
+    # "Погода в 15:00 (МСК) 17.10.2026" -> unix time
+    match = re.search(r'(\d{1,2}):(\d{2}).*?(\d{1,2})\.(\d{1,2})\.(\d{4})', update_time)
+    if not match:
+        return None
+    hour, minute, day, month, year = map(int, match.groups())
+    try:
+        return datetime(year, month, day, hour, minute, tzinfo=MSK).timestamp()
+    except ValueError:
+        return None
+
+
+def parse_number(text):
+    try:
+        return float(text.replace(',', '.').replace('−', '-'))
+    except (AttributeError, ValueError):
+        return None
+
+
+class StationObservationStore:
+    def __init__(self, path, series_capacity=STATION_SERIES_CAPACITY):
+        self.path = path
+        self.series_capacity = series_capacity
+        self.observations = {}  # "регион/станция" -> {'update_time', 'weather_data', 'fetched_at'}
+        self.series = {}  # "регион/станция" -> {величина: RingSeries}
+        self.discovered_pairs = []  # станции со страниц регионов
+        self.discovered_at = 0
+        self.crawled_at = 0  # конец последнего обхода краулером
+        self._load()
+
+    @staticmethod
+    def key(region_code, station_code):
+        return f"{region_code}/{station_code}"
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, mode='r', encoding='utf-8') as file:
+                data = json.load(file)
+            if 'observations' not in data:
+                # старый формат: весь файл - "регион/станция" -> наблюдение, рядов еще нет
+                data = {'observations': data}
+                for key, observation in data['observations'].items():
+                    self._record(key, observation)
+            self.observations = data.get('observations', {})
+            discovery = data.get('discovery', {})
+            self.discovered_pairs = [tuple(pair) for pair in discovery.get('pairs', [])]
+            self.discovered_at = discovery.get('at', 0)
+            self.crawled_at = data.get('crawled_at', 0)
+            for key, variables in data.get('series', {}).items():
+                self.series[key] = {
+                    name: RingSeries.from_json(self.series_capacity, values) for name, values in variables.items()
+                }
+        except Exception as e:
+            print(f"Ошибка чтения наблюдений станций: {e}")
+
+    def get(self, region_code, station_code):
+        return self.observations.get(self.key(region_code, station_code))
+
+    def put(self, region_code, station_code, page):
+        observation = {
+            'update_time': page['update_time'],
+            'weather_data': page['weather_data'],
+            'fetched_at': time.time(),
+        }
+        key = self.key(region_code, station_code)
+        self.observations[key] = observation
+        self._record(key, observation)
+        return observation
+
+    def _record(self, key, observation):
+        timestamp = parse_observation_time(observation['update_time']) or observation['fetched_at']
+        variables = self.series.setdefault(key, {})
+        for name, column in STATION_SERIES_VARIABLES.items():
+            value = parse_number(observation['weather_data'].get(column))
+            if value is None:
+                continue
+            if name not in variables:
+                variables[name] = RingSeries(self.series_capacity)
+            variables[name].append(timestamp, value)
+
+    def window(self, key, name, since):
+        series = self.series.get(key, {}).get(name)
+        if series is None:
+            return array('d'), array('d')
+        return series.window(since)
+
+    @staticmethod
+    def age(observation):
+        return time.time() - observation['fetched_at']
+
+    def pairs(self):
+        return [tuple(key.split('/', 1)) for key in self.observations]
+
+    def discovered(self, pairs):
+        self.discovered_pairs = sorted(pairs)
+        self.discovered_at = time.time()
+
+    def _save(self, data):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, mode='w', encoding='utf-8') as file:
+                json.dump(data, file, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Ошибка сохранения наблюдений станций: {e}")
+
+    async def save(self):
+        data = {
+            'observations': dict(self.observations),
+            'series': {
+                key: {name: series.to_json() for name, series in variables.items()}
+                for key, variables in self.series.items()
+            },
+            'discovery': {'pairs': list(self.discovered_pairs), 'at': self.discovered_at},
+            'crawled_at': self.crawled_at,
+        }
+        await asyncio.to_thread(self._save, data)
+
+
+station_store = StationObservationStore(STATIONS_FILE)
+crawler_stats = {
+    'runs': 0,
+    'last_started': None,
+    'last_duration': None,
+    'pages_ok': 0,
+    'pages_failed': 0,
+    'last_failed': 0,
+    'stations_known': 0,
+}
+
+
+def crawler_metrics():
+    return [
+        ('stations_crawl_runs_total', 'counter', {}, crawler_stats['runs']),
+        ('stations_crawl_pages_total', 'counter', {'result': 'ok'}, crawler_stats['pages_ok']),
+        ('stations_crawl_pages_total', 'counter', {'result': 'failed'}, crawler_stats['pages_failed']),
+        ('stations_crawl_last_duration_seconds', 'gauge', {}, crawler_stats['last_duration'] or 0),
+        ('stations_crawl_last_failed', 'gauge', {}, crawler_stats['last_failed']),
+        ('stations_crawl_last_started_timestamp_seconds', 'gauge', {}, crawler_stats['last_started'] or 0),
+        ('stations_known', 'gauge', {}, crawler_stats['stations_known']),
+    ]
+
+
+metrics.register_collector(crawler_metrics)
+metrics.describe('stations_crawl_runs_total', 'Завершенных обходов метеостанций')
+metrics.describe('stations_crawl_pages_total', 'Страниц станций, скачанных краулером, по результату')
+metrics.describe('stations_crawl_last_duration_seconds', 'Длительность последнего обхода, сек')
+metrics.describe('stations_crawl_last_failed', 'Страниц с ошибкой в последнем обходе')
+metrics.describe('stations_crawl_last_started_timestamp_seconds', 'Unix-время начала последнего обхода')
+metrics.describe('stations_known', 'Станций в списке обхода')
+
+
+def parse_region_station_codes(html, region_code):
+    pattern = re.compile(r'/pogoda/russia/' + re.escape(region_code) + r'/([A-Za-z0-9_\'-]+)')
+    return set(pattern.findall(html))
+
+
+async def discover_station_pairs():
+    known_codes = set(stations_dict.values())
+    pairs = set()
+    loop = asyncio.get_running_loop()
+    for region_code in regions_dict.values():
+        try:
+            html = await fetch_text(REGION_URL.format(region=region_code))
+            codes = await loop.run_in_executor(parse_executor, parse_region_station_codes, html, region_code)
+            pairs.update((region_code, code) for code in codes & known_codes)
+        except Exception as e:
+            print(f"[ERROR] Не удалось прочитать список станций региона {region_code}: {e}")
+        await asyncio.sleep(STATION_CRAWL_PAUSE)
+    return pairs
+
+
+async def crawl_station(region_code, station_code):
+    html = await fetch_text(STATION_URL.format(region=region_code, station=station_code))
+    loop = asyncio.get_running_loop()
+    page = await loop.run_in_executor(parse_executor, parse_station_page, html)
+    if page['weather_data'] is None:
+        raise ValueError("нет таблицы с данными")
+    station_store.put(region_code, station_code, page)
+
+
+async def crawl_stations(pairs):
+    started = time.monotonic()
+    crawler_stats['last_started'] = time.time()
+    queue = asyncio.Queue()
+    for pair in sorted(pairs):
+        queue.put_nowait(pair)
+    failed = 0
+
+    async def worker():
+        nonlocal failed
+        while not queue.empty():
+            region_code, station_code = queue.get_nowait()
+            try:
+                await crawl_station(region_code, station_code)
+                crawler_stats['pages_ok'] += 1
+            except Exception as e:
+                failed += 1
+                crawler_stats['pages_failed'] += 1
+                print(f"[ERROR] Краулер: {region_code}/{station_code}: {e}")
+            await asyncio.sleep(STATION_CRAWL_PAUSE)
+
+    await asyncio.gather(*(worker() for _ in range(STATION_CRAWL_CONCURRENCY)))
+    crawler_stats['runs'] += 1
+    crawler_stats['last_failed'] = failed
+    crawler_stats['last_duration'] = round(time.monotonic() - started, 1)
+    crawler_stats['stations_known'] = len(pairs)
+    station_store.crawled_at = time.time()
+    await station_store.save()
+
+
+def seconds_until_next_crawl(now=None):
+    now = now if now is not None else time.time()
+    period = STATION_CRAWL_TERM_HOURS * 3600
+    next_run = (now - STATION_CRAWL_DELAY) // period * period + period + STATION_CRAWL_DELAY
+    return next_run - now
+
+
+def last_crawl_time(now=None):
+    now = now if now is not None else time.time()
+    return now + seconds_until_next_crawl(now) - STATION_CRAWL_TERM_HOURS * 3600
+
+
+async def stations_crawler():
+    # после рестарта не обходим станции заново, если сохраненный обход свежее последнего срока
+    if station_store.crawled_at >= last_crawl_time():
+        await asyncio.sleep(seconds_until_next_crawl())
+    while True:
+        if time.time() - station_store.discovered_at > STATION_DISCOVERY_INTERVAL:
+            station_store.discovered(await discover_station_pairs())
+        # и станции, которые запрашивали пользователи
+        pairs = set(station_store.discovered_pairs) | set(station_store.pairs())
+        await crawl_stations(pairs)
+        await asyncio.sleep(seconds_until_next_crawl())
+
+
 # Stations command (async)
-@bot.on.message(text=["🚩Метеостанции РФ", "/stations"])
 async def stations_handler(message: Message):
+    await enter_dialog(message.from_id, 'stations_region')
     await message.answer("Введите регион (например, Московская область):")
-    user_id = message.from_id
-    clear_user_handlers(user_id)
-    current_handlers[user_id] = process_region
 
 
+@dialog_state('stations_region')
 async def process_region(msg: Message):
     if msg.text.lower() in ["отмена", "cancel"]:
         await msg.answer("❌ Отменено", keyboard=EMPTY_KEYBOARD)
-        clear_user_handlers(msg.from_id)
+        await end_dialog(msg.from_id)
         return
     region_name = msg.text.lower().strip()
     if region_name not in regions_dict:
         await msg.answer("регион не найден. Проверьте правильность написания.")
         return
     region_code = regions_dict[region_name]
+    await enter_dialog(msg.from_id, 'stations_station', region_code=region_code)
     await msg.answer("Введите название станции (например, Клин):")
-    current_handlers[msg.from_id] = lambda m: process_station(m, region_code)
 
 
+@dialog_state('stations_station')
 async def process_station(msg: Message, region_code: str):
     if msg.text.lower() in ["отмена", "cancel"]:
         await msg.answer("❌ Отменено", keyboard=EMPTY_KEYBOARD)
-        clear_user_handlers(msg.from_id)
+        await end_dialog(msg.from_id)
         return
     station_name = msg.text.lower().strip()
     if station_name not in stations_dict:
@@ -1633,32 +3681,24 @@ async def process_station(msg: Message, region_code: str):
         return
     station_code = stations_dict[station_name]
     url = f"https://meteoinfo.ru/pogoda/russia/{region_code}/{station_code}"
+    await end_dialog(msg.from_id)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=10) as response:
-                response.raise_for_status()
-                html = await response.text()
-        soup = BeautifulSoup(html, "html.parser")
-        update_time = soup.find("td", {"colspan": "2", "align": "right"})
-        update_time = update_time.text.strip() if update_time else "Нет данных о времени обновления"
-
-        table = soup.find("table", {"border": "0", "style": "width:100%"})
-        if not table:
-            await msg.answer("Не удалось найти данные о погоде для указанной станции.")
-            return
-
-        weather_data = {}
-        for row in table.find_all("tr"):
-            columns = row.find_all("td")
-            if len(columns) == 2:
-                parameter = columns[0].text.strip()
-                value = columns[1].text.strip()
-                weather_data[parameter] = value
+        observation = station_store.get(region_code, station_code)
+        if observation is None or station_store.age(observation) > STATION_OBSERVATION_MAX_AGE:
+            # Станции нет в хранилище или краулер давно ее не обходил: идем на сайт сами
+            page = await fetch_parsed(url, parse_station_page, STATION_CACHE_TTL)
+            if page['weather_data'] is None:
+                await msg.answer("Не удалось найти данные о погоде для указанной станции.")
+                return
+            observation = station_store.put(region_code, station_code, page)
+        update_time = observation['update_time']
+        weather_data = observation['weather_data']
+        age_minutes = int(station_store.age(observation) // 60)
 
         message_text = (
             f"📍 Погода для станции: {station_name.capitalize()}\n"
-            f"🕒 Обновлено: {update_time}\n"
+            f"🕒 Обновлено: {update_time} (получено {age_minutes} мин назад)\n"
             f"🌡️ Температура воздуха: {weather_data.get('Температура воздуха, °C', 'Нет данных')} °C\n"
             f"🌬️ Средняя скорость ветра: {weather_data.get('Средняя скорость ветра, м/с', 'Нет данных')} м/с\n"
             f"➡️ Направление ветра: {weather_data.get('Направление ветра', 'Нет данных')}\n"
@@ -1670,129 +3710,183 @@ async def process_station(msg: Message, region_code: str):
             f"❄️ Высота снежного покрова: {weather_data.get('Высота снежного покрова, см', 'Нет данных')} см\n"
             "Данные предоставлены Гидрометцентром России"
         )
-        await msg.answer(message_text)
+        key = station_store.key(region_code, station_code)
+        keyboard = Keyboard(inline=True)
+        for hours in STATION_CHART_HOURS:
+            keyboard.add(Callback(f"График {hours} ч", {"cmd": "station_chart", "station": key, "hours": hours}))
+        await msg.answer(message_text, keyboard=keyboard)
     except Exception as e:
         await msg.answer(f"Ошибка при получении данных: {str(e)}")
-    finally:
-        clear_user_handlers(msg.from_id)
 
 
-# Guess temperature game
-@bot.on.message(text=["🎮Угадать температуру", "/guess_temp"])
-async def guess_temp_handler(message: Message):
-    user_id = message.from_id
-    
-    if user_id in user_guess_temp_state:
-        await message.answer("Вы уже участвуете в игре! Продолжайте угадывать.")
-        return
-    
-    target_temp = random.randint(-30, 40)
-    user_guess_temp_state[user_id] = {
-        "target_temp": target_temp,
-        "attempts": 0,
-        "max_attempts": 5,
-        "last_guess": time.time()
-    }
-    
-    await message.answer(
-        "🌡️ Я загадал температуру от -30°C до 40°C. Угадай её за 5 попыток!\n❓ Введи свою догадку:"
-    )
+# Графики температуры и давления по накопленным рядам станции
+STATION_CHART_HOURS = (24, 72)
+STATION_CHART_SIZE = (800, 560)
+# Встроенный шрифт PIL без кириллицы: берем DejaVu Sans из репозитория, иначе из системы
+CHART_FONT_PATHS = (
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'DejaVuSans.ttf'),
+    'DejaVuSans.ttf',
+)
+chart_fonts = {}  # размер -> шрифт, в процессе картинок
 
-    # Устанавливаем обработчик для угадывания температуры
-    current_handlers[user_id] = process_guess_temp
 
-async def process_guess_temp(message: Message):
-    user_id = message.from_id
-    if user_id not in user_guess_temp_state:
-        await message.answer("Игра не начата. Введите /guess_temp, чтобы начать.")
-        clear_user_handlers(user_id)
-        return
-    
-    if message.text.lower() in ["отмена", "cancel"]:
-        await message.answer("❌ Игра отменена.")
-        del user_guess_temp_state[user_id]
-        clear_user_handlers(user_id)
-        return
-    
-    try:
-        guess = int(message.text)
-        state = user_guess_temp_state[user_id]
-        state["attempts"] += 1
-        state["last_guess"] = time.time()
-        
-        if guess == state["target_temp"]:
-            await message.answer(
-                f"🎉 Поздравляю! Это {state['target_temp']}°C. Ты угадал за {state['attempts']} попыток!"
-            )
-            del user_guess_temp_state[user_id]
-            clear_user_handlers(user_id)
-        elif state["attempts"] >= state["max_attempts"]:
-            await message.answer(
-                f"😔 Попытки закончились. Загаданная температура была {state['target_temp']}°C."
-            )
-            del user_guess_temp_state[user_id]
-            clear_user_handlers(user_id)
+def get_chart_font(size):
+    if size not in chart_fonts:
+        for path in CHART_FONT_PATHS:
+            try:
+                chart_fonts[size] = ImageFont.truetype(path, size)
+                break
+            except OSError:
+                continue
         else:
-            difference = abs(state["target_temp"] - guess)
-            if difference > 20:
-                hint = "❄️ Очень холодно!"
-            elif difference > 10:
-                hint = "🌬️ Холодно, но ближе!"
-            elif difference > 5:
-                hint = "🌤️ Тепло, но ещё можно ближе!"
-            else:
-                hint = "🔥 Горячо! Почти у цели!"
-            await message.answer(
-                f"{hint}\n❓ Попытка {state['attempts']}/{state['max_attempts']}: Введи новую догадку:"
-            )
-            
-    except ValueError:
-        await message.answer("⚠️ Пожалуйста, вводите целое число.")
+            print("[ERROR] Шрифт DejaVuSans.ttf не найден, подписи графиков без кириллицы")
+            chart_fonts[size] = ImageFont.load_default(size)
+    return chart_fonts[size]
+
+
+def render_station_chart(title, since, until, panels):
+    # panels: [(подпись, цвет, times, values)], times/values - array('d'); выполняется в процессе картинок
+    width, height = STATION_CHART_SIZE
+    margin_left, margin_right, margin_top, gap = 60, 20, 30, 40
+    panel_height = (height - margin_top - gap * len(panels)) // len(panels)
+    image = Image.new('RGB', STATION_CHART_SIZE, 'white')
+    draw = ImageDraw.Draw(image)
+    title_font, label_font, tick_font = get_chart_font(16), get_chart_font(13), get_chart_font(11)
+    draw.text((margin_left, 6), title, fill='black', font=title_font)
+    span = (until - since) or 1
+    step = 6 * 3600 if until - since <= 24 * 3600 else 12 * 3600
+
+    for number, (label, color, times, values) in enumerate(panels):
+        top = margin_top + number * (panel_height + gap)
+        bottom = top + panel_height
+        left, right = margin_left, width - margin_right
+        draw.rectangle((left, top, right, bottom), outline='gray')
+        draw.text((left + 5, top + 3), label, fill=color, font=label_font)
+        if not values:
+            draw.text((left + 5, top + 20), "нет данных", fill='gray', font=label_font)
+            continue
+        low, high = min(values), max(values)
+        if high - low < 1:
+            low, high = low - 0.5, high + 0.5
+        scale = panel_height / (high - low)
+        for tick in (low, (low + high) / 2, high):
+            y = bottom - (tick - low) * scale
+            draw.line((left - 4, y, left, y), fill='gray')
+            draw.text((5, y - 6), f"{tick:.1f}", fill='black', font=tick_font)
+        tick = math.ceil(since / step) * step
+        while tick <= until:
+            x = left + (tick - since) / span * (right - left)
+            draw.line((x, top, x, bottom), fill=(230, 230, 230))
+            draw.text((x - 15, bottom + 3), datetime.fromtimestamp(tick, MSK).strftime('%d.%m %H'), fill='black', font=tick_font)
+            tick += step
+        points = [
+            (left + (t - since) / span * (right - left), bottom - (v - low) * scale)
+            for t, v in zip(times, values)
+        ]
+        if len(points) > 1:
+            draw.line(points, fill=color, width=2)
+        for x, y in points:
+            draw.ellipse((x - 2, y - 2, x + 2, y + 2), fill=color)
+
+    output = BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+
+def format_series_summary(name, unit, values):
+    summary = RingSeries.summary(values)
+    if summary is None:
+        return f"{name}: нет данных"
+    low, high, mean = summary
+    return f"{name}: мин {low:.1f}, макс {high:.1f}, среднее {mean:.1f} {unit}"
+
+
+@bot.on.raw_event(GroupEventType.MESSAGE_EVENT, MessageEvent, payload_contains={"cmd": "station_chart"})
+@rate_limited
+@instrumented
+async def handle_station_chart(event: MessageEvent):
+    try:
+        await bot.api.messages.send_message_event_answer(
+            event_id=event.object.event_id,
+            user_id=event.object.user_id,
+            peer_id=event.object.peer_id
+        )
+    except Exception as e:
+        print(f"[ERROR] Ошибка подтверждения callback: {e}")
+
+    payload = event.object.payload
+    key = payload.get("station", "")
+    hours = payload.get("hours") if payload.get("hours") in STATION_CHART_HOURS else STATION_CHART_HOURS[0]
+    until = time.time()
+    since = until - hours * 3600
+    temp_times, temp_values = station_store.window(key, 'temperature', since)
+    pres_times, pres_values = station_store.window(key, 'pressure', since)
+    if len(temp_values) < 2 and len(pres_values) < 2:
+        await bot.api.messages.send(
+            peer_id=event.object.peer_id,
+            message=f"Недостаточно наблюдений за {hours} ч для графика. Попробуйте позже.",
+            random_id=0
+        )
         return
 
-    current_handlers[user_id] = process_guess_temp
-    process_guess_temp.once = True
+    try:
+        panels = [
+            ("Температура, °C", (200, 40, 40), temp_times, temp_values),
+            ("Давление, мм рт. ст.", (40, 80, 200), pres_times, pres_values),
+        ]
+        loop = asyncio.get_running_loop()
+        with trace_span('transform', kind='station_chart'):
+            png = await loop.run_in_executor(
+                get_image_executor(), render_station_chart, f"{station_display_name(key)}, {hours} ч", since, until, panels
+            )
+        attachment = await upload_photo(png, peer_id=event.object.peer_id)
+        message_text = (
+            f"📈 Станция {station_display_name(key)} за {hours} ч ({len(temp_values)} наблюдений)\n"
+            f"{format_series_summary('🌡️ Температура', '°C', temp_values)}\n"
+            f"{format_series_summary('🔽 Давление', 'мм рт.ст.', pres_values)}"
+        )
+        await bot.api.messages.send(
+            peer_id=event.object.peer_id,
+            message=message_text,
+            attachment=attachment,
+            random_id=0
+        )
+    except Exception as e:
+        print(f"[ERROR] Ошибка построения графика станции {key}: {e}")
+        await bot.api.messages.send(
+            peer_id=event.object.peer_id,
+            message="Не удалось построить график. Попробуйте позже.",
+            random_id=0
+        )
 
 
 # Statistics command (admin only)
-@bot.on.message(text=["/stats"])
 async def stats_handler(message: Message):
     if message.from_id != ADMIN_ID:
         await message.answer("🔒 У вас нет доступа к этой команде.")
         return
     
     try:
-        if not os.path.exists(USER_STATS_FILE):
+        stats = activity_stats
+        await stats.catch_up()  # и строки, записанные другими воркерами
+        if not stats.total:
             await message.answer("📊 Статистика пока пуста.")
             return
-            
-        with open(USER_STATS_FILE, mode='r', encoding='utf-8') as file:
-            reader = csv.reader(file)
-            next(reader)  # Пропускаем заголовок
-            stats_lines = list(reader)
-            
-        if not stats_lines:
-            await message.answer("📊 Статистика пока пуста.")
-            return
-            
-        # Подсчет уникальных пользователей
-        unique_users = len({row[0] for row in stats_lines if len(row) > 0})
-        
-        # Подсчет популярных команд
-        from collections import Counter
-        commands = Counter(row[2] for row in stats_lines if len(row) > 2)
-        top_commands = "\n".join(f"{cmd}: {count}" for cmd, count in commands.most_common(5))
+
+        top_commands = "\n".join(f"{cmd}: {count}" for cmd, count in stats.commands.most_common(5))
+        today = datetime.now().strftime("%Y-%m-%d")
         
         stats_message = (
             f"📊 Общая статистика:\n"
-            f"👥 Уникальных пользователей: {unique_users}\n"
-            f"📝 Всего записей: {len(stats_lines)}\n\n"
+            f"👥 Уникальных пользователей: {len(stats.unique_users)}\n"
+            f"📅 Активных сегодня: {len(stats.daily_users.get(today, ()))}\n"
+            f"📝 Всего записей: {stats.total}\n\n"
             f"🔝 Топ-5 команд:\n{top_commands}\n\n"
             f"Последние 5 записей:\n"
         )
         
         # Добавляем последние записи
-        for row in stats_lines[-5:]:
+        for row in list(stats.recent)[-5:]:
             if len(row) >= 4:
                 stats_message += f"👤 {row[1]} ({row[0]})\n🕒 {row[3]}\n📝 {row[2]}\n───────────────\n"
                 
@@ -1803,7 +3897,6 @@ async def stats_handler(message: Message):
 
 
 # Location command
-@bot.on.message(text=["📍Определить локацию"])
 async def location_handler(message: Message):
     keyboard = Keyboard(inline=True)
     keyboard.add(Callback("Отправить местоположение", payload={"cmd": "request_location"}))
@@ -1811,12 +3904,16 @@ async def location_handler(message: Message):
 
 
 @bot.on.raw_event(GroupEventType.MESSAGE_EVENT, MessageEvent, payload_contains={"cmd": "request_location"})
+@instrumented
 async def handle_location(event: MessageEvent):
+    await enter_dialog(event.user_id, 'location')
     await event.answer("Пожалуйста, отправьте геопозицию через VK.")
-    current_handlers[event.user_id] = lambda m: process_location(m)
 
 
+@dialog_state('location')
 async def process_location(message: Message):
+    # Одна попытка: без геопозиции диалог тоже завершается, чтобы не перехватывать следующие команды
+    await end_dialog(message.from_id)
     if not message.geo:
         await message.answer("⚠️ Не удалось получить координаты.")
         return
@@ -1827,9 +3924,8 @@ async def process_location(message: Message):
         await message.answer("Не удалось определить город по координатам.")
         return
     city = data[0]['name']
-    save_city(message.from_id, city)
-    parameters = {'key': api_key, 'q': city}
-    weather_data = await fetch_json(f'{weather_url}/current.json', params=parameters)
+    await save_city(message.from_id, city)
+    weather_data = await get_weather_snapshot(city)
     if not weather_data:
         await message.answer("Не удалось получить погоду.")
         return
@@ -1838,21 +3934,21 @@ async def process_location(message: Message):
     await message.answer(f"📍 Местоположение определено: {loc}\n🌡️ Температура: {temp_c}°C")
 
 # Guess temperature game
-@bot.on.message(text=["🎮Угадать температуру", "/guess_temp"])
+# Игра - состояние диалога guess_temp, загаданное число и попытки - его параметры
+GUESS_TEMP_TTL = 60 * 60  # брошенная игра истекает через час после последней попытки, сек
+
+
 async def guess_temp_handler(message: Message):
     user_id = message.from_id
     
-    if user_id in user_guess_temp_state:
+    state, _ = await get_dialog(user_id)
+    if state is not None and state.name == 'guess_temp':
         await message.answer("Вы уже участвуете в игре! Продолжайте угадывать.")
         return
     
     target_temp = random.randint(-30, 40)
-    user_guess_temp_state[user_id] = {
-        "target_temp": target_temp,
-        "attempts": 0,
-        "max_attempts": 5,
-        "last_guess": time.time()
-    }
+    # Устанавливаем обработчик для угадывания температуры
+    await enter_dialog(user_id, 'guess_temp', target_temp=target_temp, attempts=0, max_attempts=5)
     
     keyboard = await get_main_keyboard(message.peer_id)
     await message.answer(
@@ -1860,64 +3956,175 @@ async def guess_temp_handler(message: Message):
         keyboard=keyboard
     )
 
-    # Устанавливаем обработчик для угадывания температуры
-    async def process_guess_temp(msg: Message):
-        # Проверяем что это сообщение от нужного пользователя
-        if msg.from_id != user_id:
-            return
-            
-        if user_id not in user_guess_temp_state:
-            await msg.answer("Игра не начата. Введите /guess_temp, чтобы начать.")
-            clear_user_handlers(user_id)
-            return
-        
-        if msg.text.lower() in ["отмена", "cancel"]:
-            await msg.answer("❌ Игра отменена.", keyboard=await get_main_keyboard(msg.peer_id))
-            del user_guess_temp_state[user_id]
-            clear_user_handlers(user_id)
-            return
-        
-        try:
-            guess = int(msg.text)
-            state = user_guess_temp_state[user_id]
-            state["attempts"] += 1
-            state["last_guess"] = time.time()
-            
-            if guess == state["target_temp"]:
-                await msg.answer(
-                    f"🎉 Поздравляю! Это {state['target_temp']}°C. Ты угадал за {state['attempts']} попыток!",
-                    keyboard=await get_main_keyboard(msg.peer_id)
-                )
-                del user_guess_temp_state[user_id]
-                clear_user_handlers(user_id)
-            elif state["attempts"] >= state["max_attempts"]:
-                await msg.answer(
-                    f"😔 Попытки закончились. Загаданная температура была {state['target_temp']}°C.",
-                    keyboard=await get_main_keyboard(msg.peer_id)
-                )
-                del user_guess_temp_state[user_id]
-                clear_user_handlers(user_id)
-            else:
-                difference = abs(state["target_temp"] - guess)
-                if difference > 20:
-                    hint = "❄️ Очень холодно!"
-                elif difference > 10:
-                    hint = "🌬️ Холодно, но ближе!"
-                elif difference > 5:
-                    hint = "🌤️ Тепло, но ещё можно ближе!"
-                else:
-                    hint = "🔥 Горячо! Почти у цели!"
-                await msg.answer(
-                    f"{hint}\n❓ Попытка {state['attempts']}/{state['max_attempts']}: Введи новую догадку:"
-                )
-                
-        except ValueError:
-            await msg.answer("⚠️ Пожалуйста, вводите целое число.")
 
-    process_guess_temp.once = False  # Не удаляем автоматически, так как игра многоходовая
-    current_handlers[user_id] = process_guess_temp
+@dialog_state('guess_temp', ttl=GUESS_TEMP_TTL)
+async def process_guess_temp(msg: Message, target_temp: int, attempts: int, max_attempts: int):
+    user_id = msg.from_id
+    if msg.text.lower() in ["отмена", "cancel"]:
+        await end_dialog(user_id)
+        await msg.answer("❌ Игра отменена.", keyboard=await get_main_keyboard(msg.peer_id))
+        return
+    
+    try:
+        guess = int(msg.text)
+    except ValueError:
+        await msg.answer("⚠️ Пожалуйста, вводите целое число.")
+        return
+
+    attempts += 1
+    if guess == target_temp:
+        await end_dialog(user_id)
+        await msg.answer(
+            f"🎉 Поздравляю! Это {target_temp}°C. Ты угадал за {attempts} попыток!",
+            keyboard=await get_main_keyboard(msg.peer_id)
+        )
+    elif attempts >= max_attempts:
+        await end_dialog(user_id)
+        await msg.answer(
+            f"😔 Попытки закончились. Загаданная температура была {target_temp}°C.",
+            keyboard=await get_main_keyboard(msg.peer_id)
+        )
+    else:
+        await enter_dialog(user_id, 'guess_temp', target_temp=target_temp, attempts=attempts, max_attempts=max_attempts)
+        difference = abs(target_temp - guess)
+        if difference > 20:
+            hint = "❄️ Очень холодно!"
+        elif difference > 10:
+            hint = "🌬️ Холодно, но ближе!"
+        elif difference > 5:
+            hint = "🌤️ Тепло, но ещё можно ближе!"
+        else:
+            hint = "🔥 Горячо! Почти у цели!"
+        await msg.answer(
+            f"{hint}\n❓ Попытка {attempts}/{max_attempts}: Введи новую догадку:"
+        )
+
+
+# Алиасы команд. Пишутся как на кнопках; при сборке каждый алиас регистрируется как есть,
+# нормализованным и со слэшем, так что частые варианты находятся без нормализации.
+COMMAND_ALIASES = [
+    (start_handler, ("привет", "начать", "старт", "start")),
+    (help_handler, ("🚨Помощь", "help")),
+    (donate_handler, ("🎁Поддержать", "donate")),
+    (share_handler, ("📢Поделиться ботом", "share")),
+    (set_city_handler, ("✏️Изменить город", "setcity")),
+    (now_weather_handler, ("⛅Погода сейчас", "погода", "nowweather")),
+    (forecast_weather_handler, ("📆Погода на 3 дня", "прогноз", "forecastweather")),
+    (aqi_handler, ("🌫️Качество воздуха", "aqi")),
+    (radar_map_handler, ("🗺️Радар", "радар осадков", "radarmap")),
+    (airport_weather_handler, ("✈️Погода в аэропортах", "weatherairports")),
+    (meteograms_handler, ("📊Метеограммы ГМЦ", "meteograms")),
+    (location_handler, ("📍Определить локацию", "location")),
+    (guess_temp_handler, ("🎮Угадать температуру", "guess_temp")),
+    (stations_handler, ("🚩Метеостанции РФ", "stations")),
+    (meteoweb_handler, ("🌍Карты Meteoweb", "карты погоды", "get_meteoweb")),
+    (extrainfo_handler, ("❗Экстренная информация", "extrainfo")),
+    (support_handler, ("поддержка", "support")),
+    (precipitation_map_handler, ("precipitationmap",)),
+    (anomaly_temp_map_handler, ("anomaltempmap",)),
+    (temp_water_map_handler, ("tempwatermap",)),
+    (vertical_temp_handler, ("verticaltemplayer",)),
+    (fire_hazard_map_handler, ("firehazard_map",)),
+    (alerts_handler, ("alerts", "предупреждения")),
+    (weather_websites_handler, ("weatherwebsites",)),
+    (stats_handler, ("статистика", "stats")),  # только для ADMIN_ID, проверяется в message_handler
+]
+# Команды, которые принимают город аргументом: "погода Казань", "/aqi Berlin"
+CITY_ARGUMENT_COMMANDS = {now_weather_handler, forecast_weather_handler, aqi_handler, alerts_handler}
+
+
+def build_command_router(aliases):
+    router = {}
+    for handler, names in aliases:
+        for name in names:
+            key = normalize_command(name)
+            for variant in (key, '/' + key, name.lower()):
+                if router.get(variant, handler) is not handler:
+                    raise ValueError(f"Алиас {name!r} уже занят командой {router[variant].__name__}")
+                router[variant] = handler
+    return router
+
+
+command_router = build_command_router(COMMAND_ALIASES)
+command_max_words = max(len(key.split(' ')) for key in command_router)
+command_first_words = {key.split(' ')[0] for key in command_router}
+
+
+# Фоновые службы бота: запускаются и останавливаются из lifespan в app.py
+background_tasks = []
+
+
+async def start_services():
+    await open_http_session()
+    try:
+        await import_cities_file()
+    except Exception as e:
+        print(f"[ERROR] Не удалось перенести города из {CITIES_FILE}: {e}")
+    activity_logger.start()
+    background_tasks.append(asyncio.create_task(static_maps_refresher()))
+    background_tasks.append(asyncio.create_task(stations_crawler()))
+    background_tasks.append(asyncio.create_task(airport_reports_refresher()))
+    background_tasks.append(asyncio.create_task(dialog_sweeper()))
+
+
+async def stop_services():
+    await stop_callback_tasks()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await activity_logger.stop()
+    await station_store.save()
+    await state_backend.close()
+    await close_http_session()
+    shutdown_image_executor()
+
+
+# Callback API: VK ждет "ok" в течение нескольких секунд, иначе повторяет доставку, поэтому событие
+# обрабатывается в фоне, а повторы отбрасываются по event_id (через state_backend - для всех воркеров)
+CALLBACK_EVENT_TTL = 15 * 60  # сколько помнить обработанные event_id, сек
+callback_tasks = set()
+
+
+async def handle_callback(event):
+    # -> (HTTP-статус, тело ответа)
+    if not isinstance(event, dict) or 'type' not in event:
+        return 400, 'bad request'
+    if VK_GROUP_ID is not None and event.get('group_id') != VK_GROUP_ID:
+        metrics.inc('callback_events_total', type=event['type'], result='wrong_group')
+        return 403, 'forbidden'
+    if event['type'] == 'confirmation':
+        return 200, VK_CALLBACK_CONFIRMATION or ''
+    secret = str(event.get('secret', '')).encode()
+    if not VK_CALLBACK_SECRET or not hmac.compare_digest(secret, VK_CALLBACK_SECRET.encode()):
+        metrics.inc('callback_events_total', type=event['type'], result='wrong_secret')
+        return 403, 'forbidden'
+    event_id = event.get('event_id')
+    if event_id is not None and not await state_backend.add(f'callback_event:{event_id}', 1, CALLBACK_EVENT_TTL):
+        metrics.inc('callback_events_total', type=event['type'], result='duplicate')
+        return 200, 'ok'
+    metrics.inc('callback_events_total', type=event['type'], result='accepted')
+    task = asyncio.create_task(process_callback_event(event))
+    callback_tasks.add(task)
+    task.add_done_callback(callback_tasks.discard)
+    return 200, 'ok'
+
+
+async def process_callback_event(event):
+    try:
+        await bot.process_event(event)
+    except Exception as e:
+        print(f"[ERROR] Ошибка обработки события Callback API {event.get('type')}: {e}")
+
+
+async def stop_callback_tasks():
+    for task in list(callback_tasks):
+        task.cancel()
+    await asyncio.gather(*callback_tasks, return_exceptions=True)
 
 
 # Run bot
 async def start_bot():
-    await bot.run_forever()
+    # В режиме callback события приходят через app.py, здесь нечего запускать
+    if VK_MODE == 'longpoll':
+        await bot.run_polling()